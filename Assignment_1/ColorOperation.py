@@ -89,8 +89,8 @@ class ColorConvertDialog(QDialog):
         
         self.original_layer = []
         for layer in self.parent.layer_panel.layers:
-            self.original_layer.append((layer, layer.image.copy()))
-        self.original_image = original_image.copy()
+            self.original_layer.append((layer, layer.image))
+        self.original_image = original_image
         
 
         layout = QVBoxLayout(self)
@@ -168,7 +168,7 @@ class ColorConvertDialog(QDialog):
     def restore_all_layers(self):
         """Reverts all layers to the state they were in when dialog opened"""
         for layer, image in self.original_layer:
-            layer.set_image(image.copy())
+            layer.set_image(image)
         
     def convert_to_mode(self, img, mode):
         if mode == "RGB": return img.copy()
@@ -233,10 +233,10 @@ class ColorAdjustDialog(QDialog):
         
         self.original_layer = []
         for layer in self.parent.layer_panel.layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         current_layer = self.parent.get_current_focus_layer()
         if current_layer:
-            self.original_image = current_layer.image.copy()
+            self.original_image = current_layer.image
         
         
         
@@ -414,7 +414,7 @@ class ColorAdjustDialog(QDialog):
     
     def restore_all_layers(self):
         for layer, original_img in self.original_layer:
-            layer.image = original_img.copy()
+            layer.image = original_img
     
     def apply_changes(self):
         self.preview_update(apply=True)
@@ -443,9 +443,9 @@ class ColorIntensityAdjustDialog(QDialog):
 
         self.original_layer = []
         for layer in self.parent.layer_panel.layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         current_layer = self.parent.get_current_focus_layer()
-        self.original_image = current_layer.image.copy()
+        self.original_image = current_layer.image
 
 
 
@@ -615,7 +615,7 @@ class ColorIntensityAdjustDialog(QDialog):
 
     def restore_all_layers(self):
         for layer, original_img in self.original_layer:
-            layer.image = original_img.copy()
+            layer.image = original_img
         
 
 
@@ -3,11 +3,14 @@ import cv2
 import numpy as np
 import keyboard
 from PyQt5.QtWidgets import QLabel, QApplication
-from PyQt5.QtCore import Qt, QRect, QPoint, QPointF, QMimeData
+from PyQt5.QtCore import Qt, QRect, QRectF, QPoint, QPointF, QMimeData
 from PyQt5.QtGui import (
     QPainter, QPen, QPolygonF, QImage, QColor, QFont, 
     QPixmap, 
 )
+from Assignment_2.LayerManager import LayerManager
+from Assignment_2.ImageBridge import ImageBridge
+from Assignment_2.BrushEngine import BrushStroke
 
 
 """
@@ -47,6 +50,15 @@ class SelectLabel(QLabel):
         self.draw_mode = True
         self.draw_type = "pen"
         self.pen_path = []
+        # Live stroke drawn so far, only the new segment is added on each move
+        self.stroke_overlay = None
+        # Key of canvas pixmap when stroke finished, overlay shown until canvas changes
+        self.stroke_canvas_key = None
+        # Dabs of pen and ereaser stroke, put on layer when the stroke ends
+        self.brush_stroke = None
+        self.brush_hardness = 1.0
+        self.brush_opacity = 1.0
+        self.brush_spacing = BrushStroke.spacing
         self.pen_color = parent.pen_color
         self.pen_thickness = parent.pen_thickness
     ## Line drawing
@@ -66,6 +78,8 @@ class SelectLabel(QLabel):
         self.original_image = None
         self.handle_size = 18
         self.transform_buffer = None
+        # (transform buffer, {level: [image, QImage]}) downsampled for preview
+        self.transform_preview = None
         
         self.drag_start = False
         self.drag_start_point = QPoint()
@@ -146,7 +160,7 @@ class SelectLabel(QLabel):
         # Left empty transparent
         full_img[y1:y2, x1:x2] = 0
         
-        current_layer.set_image(full_img)
+        current_layer.set_image(full_img, (x1, y1, x2, y2))
         self.parent.display_current_image()
         
         
@@ -224,14 +238,12 @@ class SelectLabel(QLabel):
             
             match self.draw_type:
                 case "pen": 
-                    self.pen_last_point = event.pos()
-                    self.pen_path = [event.pos()]
+                    self.begin_stroke(event.pos())
                 case "line":
                     self.line_start_point = event.pos()
                     self.line_end_point = event.pos()
                 case "ereaser":
-                    self.pen_last_point = event.pos()
-                    self.pen_path = [event.pos()]
+                    self.begin_stroke(event.pos())
                 case "circle"| "triangle"| "rectangle":
                     self.temp_preview = self.parent.current_focus_layer_image()
                     self.parent.original_image = self.temp_preview
@@ -369,8 +381,7 @@ class SelectLabel(QLabel):
             match self.draw_type:
                 case "pen":
                     if len(self.pen_path) > 0:
-                        self.pen_path.append(event.pos())
-                        self.update()
+                        self.extend_stroke(event.pos())
                     
                 case "line":
                     if self.line_start_point:
@@ -379,8 +390,7 @@ class SelectLabel(QLabel):
                 
                 case "ereaser":
                     if len(self.pen_path) > 0:
-                        self.pen_path.append(event.pos())
-                        self.update()
+                        self.extend_stroke(event.pos())
                 
                 case "circle"| "triangle"| "rectangle":
                     if self.shape_start_point:
@@ -426,7 +436,8 @@ class SelectLabel(QLabel):
             match self.draw_type:
                 case "pen":
                     self.pen_last_point = None
-                    self.draw_pen_on_image(self.get_draw_color(self.pen_color))
+                    self.end_stroke()
+                    self.draw_pen_on_image()
                     self.pen_path = []
                     
                 case "line":
@@ -436,7 +447,8 @@ class SelectLabel(QLabel):
                 
                 case "ereaser":
                     self.pen_last_point = None
-                    self.draw_pen_on_image((0, 0, 0, 0))
+                    self.end_stroke()
+                    self.draw_pen_on_image()
                     self.pen_path = []
                 
                 case "circle"| "triangle"| "rectangle":
@@ -453,6 +465,90 @@ class SelectLabel(QLabel):
         super().mouseReleaseEvent(event)   
 
 
+    def begin_stroke(self, pos):
+        """ Start pen or ereaser stroke on an empty overlay and stroke buffer """
+        self.pen_last_point = pos
+        self.pen_path = [pos]
+        self.stroke_canvas_key = None
+        
+        self.stroke_overlay = QPixmap(self.size())
+        self.stroke_overlay.fill(Qt.transparent)
+        
+        self.brush_stroke = None
+        layer = self.parent.get_current_focus_layer()
+        if layer is None: return
+        
+        # Only the selected area can be painted
+        clip = self.parent.selected_rect if self.selection_rect != QRect() else None
+        self.brush_stroke = BrushStroke(
+            layer.shape, max(1, round(self.pen_thickness)), self.pen_color, 
+            self.brush_opacity, self.brush_hardness, erase=self.draw_type == "ereaser", 
+            clip=clip, spacing=self.brush_spacing
+        )
+        self.stamp_stroke(pos)
+    
+    def extend_stroke(self, pos):
+        """ Stamp dabs of the new segment, redraw and repaint only their area """
+        self.pen_path.append(pos)
+        self.stamp_stroke(pos)
+    
+    def stamp_stroke(self, pos):
+        """ Stamp dabs up to pos on stroke buffer, copy the changed area to overlay """
+        if self.brush_stroke is None or self.stroke_overlay is None: return
+        
+        sx, sy = self.parent.display_scale_x, self.parent.display_scale_y
+        ox, oy = self.parent.display_offset
+        rect = self.brush_stroke.stroke_to((pos.x() - ox) / sx, (pos.y() - oy) / sy)
+        if rect is None: return
+        
+        # Opaque coverage, the stroke opacity is applied once when painted
+        color, _ = self.stroke_style()
+        x1, y1, x2, y2 = rect
+        preview = self.brush_stroke.preview(rect, (color.blue(), color.green(), color.red()))
+        target = QRectF(x1 * sx + ox, y1 * sy + oy, (x2 - x1) * sx, (y2 - y1) * sy)
+        
+        # Coverage only grows, replace the area instead of blending on it
+        painter = QPainter(self.stroke_overlay)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(target, ImageBridge.to_qimage(preview))
+        painter.end()
+        
+        self.update(target.toAlignedRect().adjusted(-1, -1, 1, 1))
+    
+    def end_stroke(self):
+        """ Keep overlay until the canvas with the stroke is displayed """
+        pixmap = self.pixmap()
+        self.stroke_canvas_key = pixmap.cacheKey() if pixmap is not None else None
+    
+    def stroke_style(self):
+        """ (opaque color, opacity) of live stroke """
+        if self.draw_type == "ereaser":
+            return QColor(200, 200, 200), 155 / 255 * self.brush_opacity
+        
+        b, g, r = self.pen_color
+        layer = self.parent.get_current_focus_layer()
+        # Nothing is drawn without layer
+        return QColor(r, g, b), 0.0 if layer is None else layer.opacity * self.brush_opacity
+    
+    def paint_stroke_overlay(self, rect):
+        if self.stroke_overlay is None: return
+        
+        # Finished stroke is in canvas now
+        if self.stroke_canvas_key is not None:
+            pixmap = self.pixmap()
+            if pixmap is None or pixmap.cacheKey() != self.stroke_canvas_key:
+                self.stroke_overlay = None
+                self.stroke_canvas_key = None
+                return
+        
+        _, opacity = self.stroke_style()
+        if opacity <= 0: return
+        
+        painter = QPainter(self)
+        painter.setOpacity(opacity)
+        painter.drawPixmap(rect, self.stroke_overlay, rect)
+        painter.end()
+
     def paintEvent(self, event):
         super().paintEvent(event)
     
@@ -476,35 +572,14 @@ class SelectLabel(QLabel):
             x2 = self.handle_list[3].x()
             y2 = self.handle_list[3].y()
             
-            image = self.transform_buffer.copy()
             dest_w = x2 - x1
             dest_h = y2 - y1
             
-            # Horizontal Flip check
-            if dest_w < 0:
-                image = cv2.flip(image, 1) # Flip Horizontal
-                dest_w = abs(dest_w)
-                draw_x = x2
-            else: draw_x = x1
-            # Vertical Flip check
-            if dest_h < 0:
-                image = cv2.flip(image, 0)
-                dest_h = abs(dest_h)
-                draw_y = y2
-            else: draw_y = y1
-            
-            
-            resized_preview = cv2.resize(image, (dest_w, dest_h), interpolation=cv2.INTER_LINEAR)
-
-            # Convert to QImage for Qt Drawing
-            h, w, ch = resized_preview.shape
-            bytes_per_line = ch * w
-            rgb_data = cv2.cvtColor(resized_preview, cv2.COLOR_BGRA2RGBA)
-            q_img = QImage(
-                rgb_data.data, 
-                w, h, bytes_per_line, 
-                QImage.Format_RGBA8888
-            )
+            # Horizontal / Vertical Flip check
+            flip_x, flip_y = dest_w < 0, dest_h < 0
+            draw_x = x2 if flip_x else x1
+            draw_y = y2 if flip_y else y1
+            dest_w, dest_h = abs(dest_w), abs(dest_h)
             
             ## Calculate Screen coordinat
             sx = self.parent.display_scale_x
@@ -516,12 +591,19 @@ class SelectLabel(QLabel):
             screen_w = int(dest_w * sx)
             screen_h = int(dest_h * sy)
             
+            # Resampled to screen size by Qt, from the level close to it
+            buf_h, buf_w = self.transform_buffer.shape[:2]
+            q_img = self.transform_preview_image(min(screen_w / buf_w, screen_h / buf_h))
+            
             painter = QPainter(self)
-            # painter.setOpacity(0.7) 
-            painter.drawImage(
-                QRect(screen_x, screen_y, screen_w, screen_h), 
-                q_img
-            )
+            painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+            
+            # Flip by painter, the image is not changed
+            painter.save()
+            painter.translate(screen_x + screen_w * flip_x, screen_y + screen_h * flip_y)
+            painter.scale(-1 if flip_x else 1, -1 if flip_y else 1)
+            painter.drawImage(QRect(0, 0, screen_w, screen_h), q_img)
+            painter.restore()
             
             # Draw the bordering box
             painter.setPen(QPen(Qt.blue, 2, Qt.DashLine))
@@ -573,28 +655,8 @@ class SelectLabel(QLabel):
         elif self.draw_mode:
             match self.draw_type:
                 
-                case "pen":
-                    painter = QPainter(self)
-                    painter.setRenderHint(QPainter.Antialiasing, True)
-                    
-                    # Use the same color/thickness as the tool
-                    b,g,r   = self.pen_color
-                    layer   = self.parent.get_current_focus_layer()
-                    if layer is None: return
-                    if layer is None: a = 255
-                    else: a = int(layer.opacity * 255)
-                    
-                    pen = QPen(QColor(r,g,b,a), 
-                                max(1,round(self.pen_thickness)) * self.parent.display_scale_x, 
-                                Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-                    painter.setPen(pen)
-                    painter.setBrush(Qt.transparent)
-                        
-                    # Draw the list of points
-                    if len(self.pen_path) > 0:
-                        poly_path = QPolygonF(self.pen_path)
-                        painter.drawPolyline(poly_path)
-                    painter.end()
+                case "pen" | "ereaser":
+                    self.paint_stroke_overlay(event.rect())
                 
                 case "line":
                     painter = QPainter(self)
@@ -626,25 +688,6 @@ class SelectLabel(QLabel):
                         painter.drawLine(p1, p2)
                     painter.end()
     
-                case "ereaser":
-                    painter = QPainter(self)
-                    painter.setRenderHint(QPainter.Antialiasing, True)
-                    
-                    # Use the same color/thickness as the tool
-                    b,g,r,a   = 200, 200, 200, 155
-                    
-                    pen = QPen(QColor(r,g,b,a), 
-                                max(1,round(self.pen_thickness)) * self.parent.display_scale_x, 
-                                Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-                    painter.setPen(pen)
-                    painter.setBrush(Qt.transparent)
-                        
-                    # Draw the list of points
-                    if len(self.pen_path) > 0:
-                        poly_path = QPolygonF(self.pen_path)
-                        painter.drawPolyline(poly_path)
-                    painter.end()
-    
                 case "circle"| "triangle"| "rectangle":
                     
                     painter = QPainter(self)
@@ -792,42 +835,55 @@ class SelectLabel(QLabel):
             return (*base_color, 255) 
         return base_color
     
-    def draw_pen_on_image(self, color):
-        scale = self.parent.display_scale_x
-        offset_x, offset_y = self.parent.display_offset
-        thickness = max(1, round(self.pen_thickness))
-        
-        pts = []
-        for p in self.pen_path:
-            ix = int((p.x() - offset_x) / scale)
-            iy = int((p.y() - offset_y) / scale)
-            pts.append([ix, iy])
+    def get_stroke_rect(self, points, thickness):
+        """
+        Bounding area (x1, y1, x2, y2) of stroke points on image, include thickness
+        """
+        pts = np.asarray(points).reshape(-1, 2)
+        pad = thickness // 2 + 2
+        x1, y1 = pts.min(axis=0) - pad
+        x2, y2 = pts.max(axis=0) + pad + 1
+        return (int(x1), int(y1), int(x2), int(y2))
+    
+    def draw_stroke_area(self, rect, draw, clip=None):
+        """
+        Draw on current layer only inside rect (x1, y1, x2, y2), for small strokes on large image \n
+        draw(region, offset): draw on region with image points moved by offset \n
+        clip: selected area (x1, y1, x2, y2), nothing is drawn outside it
+        """
+        current_layer = self.parent.get_current_focus_layer()
+        if current_layer is None: return
         
-        points_array = np.array(pts, np.int32)
-        points_array = points_array.reshape((-1, 1, 2))
+        h, w = current_layer.shape[:2]
+        x1, y1 = max(rect[0], 0), max(rect[1], 0)
+        x2, y2 = min(rect[2], w), min(rect[3], h)
+        
+        # Whole stroke is drawn, cutting it by selection changes the line shape of OpenCV
+        cx1, cy1, cx2, cy2 = x1, y1, x2, y2
+        if clip is not None:
+            cx1, cy1 = max(x1, clip[0]), max(y1, clip[1])
+            cx2, cy2 = min(x2, clip[2]), min(y2, clip[3])
+        if cx1 >= cx2 or cy1 >= cy2: return
+        
+        # Only the stroke area is copied, drawn and written back
+        region = current_layer.peek_image()[y1:y2, x1:x2].copy()
+        draw(region, np.array([-x1, -y1], np.int32))
+        current_layer.patch_image(
+            region[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1], (cx1, cy1, cx2, cy2)
+        )
+    
+    def draw_pen_on_image(self):
+        """ Put the finished brush stroke on current layer, only the stroke area is changed """
+        stroke, self.brush_stroke = self.brush_stroke, None
+        current_layer = self.parent.get_current_focus_layer()
+        if stroke is None or current_layer is None: return
+        if current_layer.shape[:2] != stroke.coverage.shape: return
         
+        result = stroke.apply(current_layer.peek_image())
+        if result is None: return
         
-        image = self.parent.current_focus_layer_image()
-        if image is None: return
-
-        # 3. Apply to Image (Handle Selection Masking)
-        if self.selection_rect != QRect():
-            # Draw on a temp copy if selection exists
-            region_x1, region_y1, region_x2, region_y2 = self.parent.selected_rect
-            region = image.copy()
-            
-            # Draw polyline
-            cv2.polylines(region, [points_array], False, color, thickness)
-            
-            # Paste only the selected area back
-            image[region_y1:region_y2, region_x1:region_x2] = \
-                region[region_y1:region_y2, region_x1:region_x2].copy()
-        else:
-            # Draw directly
-            cv2.polylines(image, [points_array], False, color, thickness)
-
-        # 4. Finalize update
-        self.parent.current_focus_layer_image(image)
+        patch, rect = result
+        current_layer.patch_image(patch, rect)
         self.parent.display_current_image()
     
     def draw_line_on_image(self, start_pos, end_pos, color):
@@ -853,23 +909,16 @@ class SelectLabel(QLabel):
 
             thickness = max(1, round(self.pen_thickness))
             color_bgra = self.get_draw_color(color)
-            image = self.parent.current_focus_layer_image().copy()
-            if image is None: return
-
-            # Draw the line directly on selected area
-            if self.selection_rect != QRect():
-                region_x1, region_y1, region_x2, region_y2 = self.parent.selected_rect
-                region = image.copy()
-                
-                cv2.line(region, (x1, y1), (x2, y2), color_bgra, thickness)
-                image[region_y1:region_y2, region_x1:region_x2] = \
-                    region[region_y1:region_y2, region_x1:region_x2].copy()
-                
-            else:
-                # Draw the line directly on the image
-                cv2.line(image, (x1, y1), (x2, y2), color_bgra, thickness)
+            if self.parent.current_focus_layer_image() is None: return
 
-            self.parent.current_focus_layer_image(image)
+            # Draw the line only inside its area (and the selected area if exists)
+            def draw_line(region, offset):
+                dx, dy = int(offset[0]), int(offset[1])
+                cv2.line(region, (x1 + dx, y1 + dy), (x2 + dx, y2 + dy), color_bgra, thickness)
+            
+            clip = self.parent.selected_rect if self.selection_rect != QRect() else None
+            rect = self.get_stroke_rect([(x1, y1), (x2, y2)], thickness)
+            self.draw_stroke_area(rect, draw_line, clip)
             self.parent.display_current_image()
             self.update()
     
@@ -879,7 +928,6 @@ class SelectLabel(QLabel):
 
         current_layer = self.parent.get_current_focus_layer()
         if current_layer is None: return
-        img = current_layer.image.copy()
         
         # Calculate point on layer  
         sx, sy    = self.parent.display_scale_x, self.parent.display_scale_y
@@ -900,32 +948,31 @@ class SelectLabel(QLabel):
             if y2 > y1: y2 = y1 + side_length
             else: y2 = y1 - side_length
 
-        region = img.copy()
-        match shape_type:
-            case "rectangle":
-                cv2.rectangle(region, (x1, y1), (x2, y2), color, thickness)
+        def draw_shape(region, offset):
+            dx, dy = int(offset[0]), int(offset[1])
+            ax1, ay1, ax2, ay2 = x1 + dx, y1 + dy, x2 + dx, y2 + dy
+            
+            match shape_type:
+                case "rectangle":
+                    cv2.rectangle(region, (ax1, ay1), (ax2, ay2), color, thickness)
 
-            case "circle":
-                # Calculate center
-                cx, cy = int((x1 + x2) / 2), int((y1 + y2) / 2)
-                
-                axis_x = abs(x2 - x1) // 2
-                axis_y = abs(y2 - y1) // 2
+                case "circle":
+                    # Calculate center
+                    cx, cy = int((x1 + x2) / 2) + dx, int((y1 + y2) / 2) + dy
+                    
+                    axis_x = abs(x2 - x1) // 2
+                    axis_y = abs(y2 - y1) // 2
+                    
+                    cv2.ellipse(region, (cx, cy), (axis_x, axis_y), 0, 0, 360, color, thickness)
                 
-                cv2.ellipse(region, (cx, cy), (axis_x, axis_y), 0, 0, 360, color, thickness)
-            
-            case "triangle":
-                pts = np.array([[x1, y2], [int((x1 + x2) / 2), y1], [x2, y2]], np.int32)
-                cv2.polylines(region, [pts], isClosed=True, color=color, thickness=thickness)
-    
-        if self.parent.selected_rect != (0,0,0,0):
-            region_x1, region_y1, region_x2, region_y2 = self.parent.selected_rect
-            img[region_y1:region_y2, region_x1:region_x2] = region[region_y1:region_y2, region_x1:region_x2]
-        else:
-            img = region
-    
+                case "triangle":
+                    pts = np.array([[ax1, ay2], [int((x1 + x2) / 2) + dx, ay1], [ax2, ay2]], np.int32)
+                    cv2.polylines(region, [pts], isClosed=True, color=color, thickness=thickness)
     
-        self.parent.current_focus_layer_image(img)
+        # Draw only inside the shape area (and the selected area if exists)
+        clip = self.parent.selected_rect if self.parent.selected_rect != (0,0,0,0) else None
+        rect = self.get_stroke_rect([(x1, y1), (x2, y2)], thickness)
+        self.draw_stroke_area(rect, draw_shape, clip)
         self.parent.display_current_image()
 
 ## Paint Bucket Functions
@@ -982,6 +1029,28 @@ class SelectLabel(QLabel):
         self.parent.display_current_image()
 
 ## Free Transform Functions
+    def transform_preview_image(self, scale):
+        """
+        Transform buffer downsampled close to preview size, as QImage ready to draw \n
+        scale: screen size / buffer size, levels are kept until the buffer changes
+        """
+        cache = self.transform_preview
+        if cache is None or cache[0] is not self.transform_buffer:
+            cache = self.transform_preview = (self.transform_buffer, {})
+        levels = cache[1]
+        
+        level = LayerManager.pyramid_level(scale)
+        for i in range(level + 1):
+            if i not in levels:
+                image = self.transform_buffer if i == 0 else LayerManager.downsample(levels[i - 1][0])
+                levels[i] = [image, None]
+        
+        # Premultiplied format is drawn by Qt without converting
+        if levels[level][1] is None:
+            image = levels[level][0]
+            levels[level][1] = ImageBridge.to_qimage(image).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        return levels[level][1]
+    
     def apply_free_transform(self, cancel=False):
         if not self.transform_mode: return
         self.transform_mode = False
@@ -995,7 +1064,7 @@ class SelectLabel(QLabel):
             
         elif self.transform_buffer is not None:
             self.selection_rect = QRect()
-            result = current_layer.image
+            result = current_layer.image.copy()
             
             x1 = self.handle_list[0].x()
             y1 = self.handle_list[0].y()
@@ -1015,10 +1084,11 @@ class SelectLabel(QLabel):
             tl_y = min(y1, y2)
             
             result = self.paste(result, overlay, tl_x, tl_y)
-            current_layer.set_image(result)
+            current_layer.set_image(result, (tl_x, tl_y, tl_x + w, tl_y + h))
             
         self.parent.display_current_image()
         self.original_image = None
+        self.transform_preview = None
 
 ## Copy Cut Paste tool
     def copy_image(self, rect: QRect):
@@ -1045,7 +1115,7 @@ class SelectLabel(QLabel):
         img = current_layer.image.copy()
         self.copied_image = img[y1:y2, x1:x2].copy()
         img[y1:y2, x1:x2] = 0
-        current_layer.set_image(img)
+        current_layer.set_image(img, (x1, y1, x2, y2))
         
         self.aspect_ratio = (x2-x1) / (y2-y1)
         self.copied_rect = (x1, y1, x2, y2)
@@ -1056,27 +1126,8 @@ class SelectLabel(QLabel):
         self.copy_to_clipboard(self.copied_image)
     
     def copy_to_clipboard(self, image):
-        img_h, img_w = image.shape[:2]
-        channels = 1 if len(image.shape) == 2 else image.shape[2]
-
-        if channels == 3:
-            temp_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGBA)
-        elif channels == 4:
-            temp_img = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
-
-        # Contiguous memory
-        if not temp_img.flags['C_CONTIGUOUS']:
-            temp_img = np.ascontiguousarray(temp_img)
-        q_image = QImage(
-            temp_img.data, 
-            img_w, 
-            img_h, 
-            img_w * 4, 
-            QImage.Format_RGBA8888
-        )
-
         # Using qmimedata so won't lost data
-        q_pixmap = QPixmap.fromImage(q_image)
+        q_pixmap = ImageBridge.to_pixmap(image)
         mime_data = QMimeData()
         mime_data.setImageData(q_pixmap.toImage())
         
@@ -1122,16 +1173,8 @@ class SelectLabel(QLabel):
                 blended = (fg_color * alpha + bg_crop * (1 - alpha))
                 bg[y1:y2, x1:x2] = blended.astype(np.uint8)
             else:
-                # Alpha to Alpha blending is harder, strictly simplified here:
-                # Standard Porter-Duff 'Source Over'
-                fg_alpha = fg_crop[:, :, 3] / 255.0
-                bg_alpha = bg_crop[:, :, 3] / 255.0
-                out_alpha = fg_alpha + bg_alpha * (1 - fg_alpha)
-                
-                out_color = (fg_crop[:,:,:3] * fg_alpha[:,:,None] + bg_crop[:,:,:3] * bg_alpha[:,:,None] * (1 - fg_alpha[:,:,None])) / (out_alpha[:,:,None] + 1e-6)
-                
-                bg[y1:y2, x1:x2, :3] = out_color.astype(np.uint8)
-                bg[y1:y2, x1:x2, 3] = (out_alpha * 255).astype(np.uint8)
+                # Standard Porter-Duff 'Source Over', same as merging layers
+                bg[y1:y2, x1:x2] = LayerManager.merge_two_layers(bg_crop, fg_crop, 1.0)
         else:
             # No alpha in overlay, just overwrite
             if bg.shape[2] == 4:
@@ -1186,16 +1229,8 @@ class SelectLabel(QLabel):
 
         q_image = clipboard.image()
         if q_image.isNull(): return
-        q_image = q_image.convertToFormat(QImage.Format_RGBA8888)
-        width = q_image.width()
-        height = q_image.height()
-
-        ptr = q_image.bits()
-        ptr.setsize(q_image.byteCount())
-        
-        
-        clipboard_view = np.array(ptr).reshape(height, width, 4)
-        clipboard_img = cv2.cvtColor(clipboard_view, cv2.COLOR_RGBA2BGRA)
+        # BGRA view on the clipboard image
+        clipboard_img = ImageBridge.to_array(q_image.convertToFormat(QImage.Format_ARGB32))
 
         paste_x, paste_y = 0, 0
         if self.copied_image is not None:
@@ -0,0 +1,167 @@
+import numpy as np
+
+
+"""
+Brush Stroke by Stamping Dabs
+"""
+class BrushStroke:
+    """
+    One brush stroke, round dabs stamped along the mouse path into a stroke buffer \n
+    Stroke buffer keeps the coverage of the stroke (max of dabs, no build-up inside one stroke), \n
+    the layer image is changed only once by apply() when the stroke ends
+    """
+
+    # Distance between dabs, ratio of brush diameter
+    spacing = 0.1
+    # Precomputed dabs {(diameter, hardness): coverage mask}
+    dab_cache = {}
+    max_dab_cache = 32
+
+    def __init__(self, shape, diameter, color=(0, 0, 0), opacity=1.0, hardness=1.0, 
+                 erase=False, clip=None, spacing=None):
+        """
+        shape: (height, width) of layer image \n
+        color: BGR color, opacity: stroke opacity 0 ~ 1, hardness: 1 hard edge, 0 soft to the center \n
+        erase: subtract the stroke from alpha instead of painting color \n
+        clip: (x1, y1, x2, y2) area which can be changed, None for whole image \n
+        spacing: distance between dabs as ratio of diameter, class default if not given
+        """
+        h, w = shape[:2]
+        self.diameter = max(1.0, float(diameter))
+        self.hardness = min(max(float(hardness), 0.0), 1.0)
+        self.color = tuple(color[:3])
+        self.opacity = min(max(float(opacity), 0.0), 1.0)
+        self.erase = erase
+        self.spacing = BrushStroke.spacing if spacing is None else spacing
+        
+        self.clip = (0, 0, w, h)
+        if clip is not None:
+            x1, y1, x2, y2 = clip
+            self.clip = (max(x1, 0), max(y1, 0), min(x2, w), min(y2, h))
+        
+        # Pages of zero buffer are only allocated when a dab touches them
+        self.coverage = np.zeros((h, w), np.uint8)
+        self.dab = BrushStroke.get_dab(self.diameter, self.hardness)
+        
+        # Stamped area (x1, y1, x2, y2), None if nothing stamped yet
+        self.rect = None
+        self.last_point = None
+        # Distance left from last dab to the next one
+        self.distance = 0.0
+
+    def get_dab(diameter, hardness):
+        """
+        Coverage mask (0 ~ 255) of one round dab, odd size with the center at the middle pixel \n
+        Cached for each size and hardness
+        """
+        key = (round(diameter * 4) / 4, round(hardness, 2))
+        dab = BrushStroke.dab_cache.get(key)
+        if dab is not None: return dab
+        
+        diameter, hardness = key
+        radius = diameter / 2
+        size = int(np.ceil(diameter)) + 2
+        size += 1 - size % 2
+        
+        c = size // 2
+        y, x = np.mgrid[:size, :size]
+        dist = np.sqrt((x - c) ** 2 + (y - c) ** 2, dtype=np.float32)
+        
+        # 1 pixel anti-aliased edge for hard brush, fade from hardness * radius for soft brush
+        fade = max(1.0, radius * (1 - hardness))
+        cover = np.clip((radius + 0.5 - dist) / fade, 0, 1)
+        cover = cover * cover * (3 - 2 * cover)
+        dab = np.round(cover * 255).astype(np.uint8)
+        dab.flags.writeable = False
+        
+        if len(BrushStroke.dab_cache) >= BrushStroke.max_dab_cache:
+            BrushStroke.dab_cache.pop(next(iter(BrushStroke.dab_cache)))
+        BrushStroke.dab_cache[key] = dab
+        return dab
+
+    def stroke_to(self, x, y):
+        """
+        Stamp dabs from last point to (x, y) in image coordinate, first call stamps one dab \n
+        Return changed area (x1, y1, x2, y2) of coverage, None if nothing changed
+        """
+        if self.last_point is None:
+            self.last_point = (x, y)
+            return self.stamp(x, y)
+        
+        lx, ly = self.last_point
+        length = np.hypot(x - lx, y - ly)
+        self.last_point = (x, y)
+        step = max(1.0, self.diameter * self.spacing)
+        
+        rect = None
+        # Keep the same spacing across mouse events
+        d = step - self.distance
+        while d <= length:
+            t = d / length
+            rect = BrushStroke.union_rect(rect, self.stamp(lx + (x - lx) * t, ly + (y - ly) * t))
+            d += step
+        self.distance = length - (d - step)
+        return rect
+
+    def stamp(self, x, y):
+        """ Stamp one dab centered at (x, y), return changed area or None """
+        n = self.dab.shape[0]
+        x1, y1 = int(round(x)) - n // 2, int(round(y)) - n // 2
+        x2, y2 = x1 + n, y1 + n
+        
+        cx1, cy1, cx2, cy2 = self.clip
+        ax1, ay1 = max(x1, cx1), max(y1, cy1)
+        ax2, ay2 = min(x2, cx2), min(y2, cy2)
+        if ax1 >= ax2 or ay1 >= ay2: return None
+        
+        area = self.coverage[ay1:ay2, ax1:ax2]
+        np.maximum(area, self.dab[ay1 - y1:ay2 - y1, ax1 - x1:ax2 - x1], out=area)
+        
+        rect = (ax1, ay1, ax2, ay2)
+        self.rect = BrushStroke.union_rect(self.rect, rect)
+        return rect
+
+    def union_rect(a, b):
+        """ Bounding area of two areas (x1, y1, x2, y2), either can be None """
+        if a is None: return b
+        if b is None: return a
+        return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+    def preview(self, rect, color=None):
+        """
+        Straight alpha BGRA image of coverage inside rect, for drawing the live stroke \n
+        color: BGR color of preview, stroke color if not given
+        """
+        x1, y1, x2, y2 = rect
+        out = np.empty((y2 - y1, x2 - x1, 4), np.uint8)
+        out[:, :, :3] = self.color if color is None else color
+        out[:, :, 3] = self.coverage[y1:y2, x1:x2]
+        return out
+
+    def apply(self, image):
+        """
+        Stroke on straight alpha BGRA image, image is not changed \n
+        Return (patch, rect) of the stroke area, None if nothing stamped
+        """
+        if self.rect is None: return None
+        x1, y1, x2, y2 = self.rect
+        
+        src = image[y1:y2, x1:x2]
+        a = self.coverage[y1:y2, x1:x2, None] * np.float32(self.opacity / 255)
+        src_a = src[:, :, 3:] * np.float32(1 / 255)
+        
+        patch = src.copy()
+        if self.erase:
+            # Only alpha is removed, color is kept
+            patch[:, :, 3:] = np.round(src_a * (1 - a) * 255)
+            return patch, self.rect
+        
+        # Stroke color over the image
+        out_a = a + src_a * (1 - a)
+        color = np.array(self.color, np.float32)
+        rgb = (color * a + src[:, :, :3] * (src_a * (1 - a))) / np.maximum(out_a, 1e-6)
+        
+        painted = out_a[:, :, 0] > 0
+        patch[:, :, :3][painted] = np.clip(np.round(rgb[painted]), 0, 255)
+        patch[:, :, 3:] = np.round(out_a * 255)
+        return patch, self.rect
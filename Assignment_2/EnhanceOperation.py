@@ -5,11 +5,12 @@ from PyQt5.QtWidgets import (
     QCheckBox, QSpinBox, QGroupBox, QGridLayout, QSizePolicy, QFrame
 )
 from PyQt5.QtGui import (
-    QImage, QPixmap, QPainter, QPen, QColor, QCloseEvent
+    QPixmap, QPainter, QPen, QColor, QCloseEvent
 )
 from PyQt5.QtCore import Qt
 
-from Assignment_2.LayerManager import LayerManager
+from Assignment_2.ImageBridge import ImageBridge
+from Assignment_2.LayerManager import LayerManager, LayerCommand
 from Assignment_2.ResizableLabel import ResizableLabel
 
 
@@ -105,18 +106,21 @@ class ImageEnhancer:
 
 
 ## Noise --------------------------------------
-    def apply_add_noise(image, strength, size):
+    def apply_add_noise(image, strength, size, rng=None):
+        """ rng: np.random.Generator of noise, new random one if not given """
         if strength == 0:
             return image
+        if rng is None:
+            rng = np.random.default_rng()
 
         h, w = image.shape[:2]
         noise_h = max(1, h // size)
         noise_w = max(1, w // size)
         
         if len(image.shape) == 3:
-            noise = np.random.normal(0, strength, (noise_h, noise_w, 3))
+            noise = rng.normal(0, strength, (noise_h, noise_w, 3))
         else:
-            noise = np.random.normal(0, strength, (noise_h, noise_w))
+            noise = rng.normal(0, strength, (noise_h, noise_w))
 
         # Resize
         if size > 1:
@@ -149,14 +153,17 @@ class ImageEnhancer:
         return cv2.filter2D(image, -1, kernel)
     
 ## Style --------------------------------------
-    def apply_diffuse(image, scale):
+    def apply_diffuse(image, scale, rng=None):
+        """ rng: np.random.Generator of offsets, new random one if not given """
         if scale == 0: 
             return image
+        if rng is None:
+            rng = np.random.default_rng()
 
         h, w = image.shape[:2]
         # Generate random number
-        rand_x = np.random.randint(-scale, scale + 1, (h, w))
-        rand_y = np.random.randint(-scale, scale + 1, (h, w))
+        rand_x = rng.integers(-scale, scale + 1, (h, w))
+        rand_y = rng.integers(-scale, scale + 1, (h, w))
 
         # Create coordinate grid
         grid_x, grid_y = np.meshgrid(np.arange(w), np.arange(h))
@@ -204,12 +211,14 @@ class EnhancePanel(QWidget):
         self.setWindowTitle(f"{method} Filters Controller")
         self.setMinimumSize(490, hsize)
         self.apply = False
+        # Same noise for previews, apply and replay
+        self.seed = np.random.default_rng().integers(2 ** 31)
 
         # Origianal layer
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
 
@@ -440,20 +449,33 @@ class EnhancePanel(QWidget):
         if self.cb_preview.isChecked():
             self.apply_on_layer()
         
-    def apply_filter(self, img):
+    def command(self):
+        """ Filter with current settings, logged for undo/redo """
+        vals = {n: s.value() for n, s in self.sliders.items()}
+        index = None
+        if not self.cb_all_layer.isChecked():
+            index = self.parent.layer_panel.active_layer_index
+        
+        return LayerCommand(
+            "enhance", {"method": self.method, "vals": vals, "seed": self.seed},
+            index, self.parent.get_focus_window().selected_rect
+        )
+    
+    def filter_image(img, method, vals, seed=0):
         """
-        Image Process 
+        Image Process by filter method and slider values \n
+        seed: random seed of noise filters, same result for same seed
         """
         if img.shape[2] == 3:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
         b, g, r, a = cv2.split(img)
         bgr = cv2.merge([b, g, r])
         
+        # Own generator, the global random state is not changed
+        rng = np.random.default_rng(seed)
         
-        vals = {n: s.value() for n, s in self.sliders.items()}
         result = bgr
         result_a = a
-        method = self.method
         
     ## Blur
         if method == "Blur" or method == "Blur More":
@@ -494,7 +516,7 @@ class EnhancePanel(QWidget):
     # Noise
         elif method == "Add Noise":
             result = ImageEnhancer.apply_add_noise(
-                bgr, vals["Strength"], vals["Size"]
+                bgr, vals["Strength"], vals["Size"], rng
             )
             # result_a = ImageEnhancer.apply_add_noise(
             #     a, vals["Strength"], vals["Size"]
@@ -516,8 +538,8 @@ class EnhancePanel(QWidget):
         
     # Style
         elif method == "Diffuse":
-            result = ImageEnhancer.apply_diffuse(bgr, vals["Scale"])
-            result_a = ImageEnhancer.apply_diffuse(a, vals["Scale"])
+            result = ImageEnhancer.apply_diffuse(bgr, vals["Scale"], rng)
+            result_a = ImageEnhancer.apply_diffuse(a, vals["Scale"], rng)
         elif method == "Solarize":
             result = ImageEnhancer.apply_solarize(bgr, vals["Threshold"])
     
@@ -545,14 +567,9 @@ class EnhancePanel(QWidget):
             target = [(current_layer, self.original_image)]
             
         # Apply process
-        current_focus = self.parent.get_focus_window()
+        command = self.command()
         for layer, image in target:
-            result = self.apply_filter(image)
-            
-            region = self.parent.get_result_by_roi(
-                image, result, current_focus.selected_rect
-            )
-            layer.set_image(region)
+            layer.set_image(command.run(image))
         self.parent.display_current_image()
         
     
@@ -562,7 +579,7 @@ class EnhancePanel(QWidget):
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
         
     def apply_btn_pressed(self):
@@ -571,6 +588,7 @@ class EnhancePanel(QWidget):
 
         self.apply = True
         self.apply_on_layer()
+        self.parent.push_undo_command(self.command())
         
         self.parent.set_dialog_open(False)
         self.parent.update_button_menu()
@@ -588,6 +606,8 @@ class EnhancePanel(QWidget):
         self.parent.update_button_menu()
         event.accept()
 
+LayerCommand.register("enhance", EnhancePanel.filter_image)
+
 
 """ Window Panel for Power Law (Gamma) Transformation """
 class PowerLawPanel(QWidget):
@@ -612,11 +632,11 @@ class PowerLawPanel(QWidget):
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
         # Original composite image
-        self.original_composite_image  = LayerManager.compose_layers(layers)
+        self.original_composite_image  = self.parent.get_composite(self.parent.current_index).copy()
         
         
 
@@ -753,14 +773,32 @@ class PowerLawPanel(QWidget):
         """
         Process
         """
+        gamma = self.get_gamma()
+        self.lbl_gamma.setText(f"Gamma: {gamma:.2f}")
+        
+        return PowerLawPanel.gamma_image(image, gamma)
+    
+    def get_gamma(self):
         val   = self.slider_gamma.value()
         gamma = val / 100.0
         # Avoid division by zero
         if gamma == 0: 
             gamma = 0.01
-        self.lbl_gamma.setText(f"Gamma: {gamma:.2f}")
-            
-            
+        return gamma
+    
+    def command(self):
+        """ Transformation with current settings, logged for undo/redo """
+        index = None
+        if not self.cb_all_layer.isChecked():
+            index = self.parent.layer_panel.active_layer_index
+        
+        return LayerCommand(
+            "power_law", {"gamma": self.get_gamma()},
+            index, self.parent.get_focus_window().selected_rect
+        )
+    
+    def gamma_image(image, gamma):
+        """ Power law transformation of rgb channels """
         table = np.array(
             [((i / 255.0) ** gamma) * 255 
                 for i in np.arange(0, 256)]
@@ -813,22 +851,7 @@ class PowerLawPanel(QWidget):
         if img.dtype != np.uint8:
             img = cv2.convertScaleAbs(img)
 
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-        elif len(img.shape) == 3:
-            if img.shape[2] == 3:     
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        h, w, _ = img.shape
-        
-        bytes_per_line = img.strides[0]
-
-        q_img = QImage(
-                img.data, 
-                w, h, bytes_per_line, 
-                QImage.Format_RGBA8888
-            ).rgbSwapped()
-        
-        pixmap = QPixmap.fromImage(q_img.copy())
+        pixmap = ImageBridge.to_pixmap(img)
         scaled = pixmap.scaled(
             self.image_label.size(), 
             Qt.KeepAspectRatio, Qt.SmoothTransformation
@@ -847,26 +870,23 @@ class PowerLawPanel(QWidget):
             target = [(current_layer, self.original_image)]
         
         # Apply process
-        current_focus = self.parent.get_focus_window()
+        command = self.command()
         for layer, image in target:
-            """ Process """
-            result = self.process_image(image)
-            
-            region = self.parent.get_result_by_roi(image, result, current_focus.selected_rect)
-            layer.set_image(region)
+            layer.set_image(command.run(image))
             
     def restore_layers(self):
         """
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
         
     def apply_btn_pressed(self):
         self.apply = True
         
         self.apply_on_layer()
+        self.parent.push_undo_command(self.command())
                    
         self.parent.display_current_image()
         self.close()
@@ -880,6 +900,7 @@ class PowerLawPanel(QWidget):
         self.parent.update_button_menu()
         event.accept()
         
+LayerCommand.register("power_law", PowerLawPanel.gamma_image)
 
 
 """ Graph Widget for Piecewise Linear Transformation """
@@ -945,11 +966,11 @@ class PiecewisePanel(QWidget):
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
         # Original composite image
-        self.original_composite_image  = LayerManager.compose_layers(layers)
+        self.original_composite_image  = self.parent.get_composite(self.parent.current_index).copy()
         
         
         
@@ -1275,22 +1296,7 @@ class PiecewisePanel(QWidget):
         if img.dtype != np.uint8:
             img = cv2.convertScaleAbs(img)
 
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-        elif len(img.shape) == 3:
-            if img.shape[2] == 3:     
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        h, w, _ = img.shape
-            
-            
-        bytes_per_line = img.strides[0]
-        q_img = QImage(
-                img.data, 
-                w, h, bytes_per_line, 
-                QImage.Format_RGBA8888
-            ).rgbSwapped()
-         
-        pixmap = QPixmap.fromImage(q_img.copy())
+        pixmap = ImageBridge.to_pixmap(img)
         scaled = pixmap.scaled(
             self.image_label.size(), 
             Qt.KeepAspectRatio, Qt.SmoothTransformation
@@ -1323,7 +1329,7 @@ class PiecewisePanel(QWidget):
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
        
     def apply_btn_pressed(self):
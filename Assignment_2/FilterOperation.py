@@ -10,11 +10,12 @@ from PyQt5.QtWidgets import (
     
 )
 from PyQt5.QtGui import (
-    QImage, QPixmap, QCloseEvent
+    QPixmap, QCloseEvent
 )
 from PyQt5.QtCore import Qt
 
-from Assignment_2.LayerManager import LayerManager
+from Assignment_2.ImageBridge import ImageBridge
+from Assignment_2.LayerManager import LayerManager, LayerCommand
 from Assignment_2.ResizableLabel import ResizableLabel
     
 
@@ -226,11 +227,11 @@ class EdgeDetectionPanel(QWidget):
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
         # Original composite image
-        self.original_composite_image  = LayerManager.compose_layers(layers)
+        self.original_composite_image  = self.parent.get_composite(self.parent.current_index).copy()
         
         
 
@@ -614,21 +615,7 @@ class EdgeDetectionPanel(QWidget):
         if img.dtype != np.uint8:
             img = cv2.convertScaleAbs(img)
 
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-        elif len(img.shape) == 3:
-            if img.shape[2] == 3:     
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        h, w, _ = img.shape
-
-
-        bytes_per_line = img.strides[0]
-        q_img = QImage(
-            img.data, 
-            w, h, bytes_per_line, 
-            QImage.Format_RGBA8888
-            ).rgbSwapped()
-        pixmap = QPixmap.fromImage(q_img.copy())
+        pixmap = ImageBridge.to_pixmap(img)
 
         scaled_pixmap = pixmap.scaled(
             self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
@@ -661,7 +648,7 @@ class EdgeDetectionPanel(QWidget):
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
         
     def apply_btn_pressed(self):
@@ -702,12 +689,12 @@ class ThresholdPanel(QWidget):
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
             
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
         # Original composite image
-        self.original_composite_image  = LayerManager.compose_layers(layers)
+        self.original_composite_image  = self.parent.get_composite(self.parent.current_index).copy()
 
 
         
@@ -955,21 +942,7 @@ class ThresholdPanel(QWidget):
         if img.dtype != np.uint8:
             img = cv2.convertScaleAbs(img)
 
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-        elif len(img.shape) == 3:
-            if img.shape[2] == 3:     
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        h, w, _ = img.shape
-        
-            
-        bytes_per_line = img.strides[0]
-        q_img = QImage(
-            img.data, 
-            w, h, bytes_per_line, 
-            QImage.Format_RGBA8888
-        ).rgbSwapped()
-        pixmap = QPixmap.fromImage(q_img.copy())
+        pixmap = ImageBridge.to_pixmap(img)
         
         scaled_pixmap = pixmap.scaled(
             self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
@@ -982,7 +955,7 @@ class ThresholdPanel(QWidget):
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
         
     def apply_btn_pressed(self):
@@ -1024,11 +997,11 @@ class MorphologyPanel(QWidget):
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
         # Original composite image
-        self.original_composite_image  = LayerManager.compose_layers(layers)
+        self.original_composite_image  = self.parent.get_composite(self.parent.current_index).copy()
         
         
         
@@ -1274,19 +1247,39 @@ class MorphologyPanel(QWidget):
         self.setLayout(main_layout)
 
     def process_image(self, image):
+        params = self.get_params()
+        k_val, iters = params["k_val"], params["iters"]
+        self.lbl_ksize.setText(f"Kernel Size: {k_val}x{k_val}")
+        self.lbl_iter.setText(f"Iterations: {iters} times")
+        
+        return MorphologyPanel.morph_image(image, **params)
+    
+    def get_params(self):
         # Get Selected Operation
         op_id = self.op_group.checkedId()
         if op_id == -1: op_id = 0
-
-        shape_idx = self.combo_shape.currentIndex()
         
         k_val = self.slider_ksize.value()
         if k_val % 2 == 0: k_val += 1
-        self.lbl_ksize.setText(f"Kernel Size: {k_val}x{k_val}")
         
-        iters = self.slider_iter.value()
-        self.lbl_iter.setText(f"Iterations: {iters} times")
-
+        return {
+            "op_id": op_id, "shape_idx": self.combo_shape.currentIndex(),
+            "k_val": k_val, "iters": self.slider_iter.value()
+        }
+    
+    def command(self):
+        """ Operation with current settings, logged for undo/redo """
+        index = None
+        if not self.cb_all_layer.isChecked():
+            index = self.parent.layer_panel.active_layer_index
+        
+        return LayerCommand(
+            "morphology", self.get_params(),
+            index, self.parent.get_focus_window().selected_rect
+        )
+    
+    def morph_image(image, op_id, shape_idx, k_val, iters):
+        """ Morphology operation by operation id, kernel shape, size and iterations """
         # 2. Define Kernel
         morph_shape = cv2.MORPH_RECT
         if shape_idx == 1: morph_shape = cv2.MORPH_CROSS
@@ -1349,21 +1342,7 @@ class MorphologyPanel(QWidget):
         if img.dtype != np.uint8:
             img = cv2.convertScaleAbs(img)
 
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-        elif len(img.shape) == 3:
-            if img.shape[2] == 3:     
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        h, w, _ = img.shape
-
-
-        bytes_per_line = img.strides[0]
-        q_img = QImage(
-            img.data, 
-            w, h, bytes_per_line, 
-            QImage.Format_RGBA8888
-            ).rgbSwapped()
-        pixmap = QPixmap.fromImage(q_img.copy())
+        pixmap = ImageBridge.to_pixmap(img)
 
         scaled_pixmap = pixmap.scaled(
             self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
@@ -1383,26 +1362,23 @@ class MorphologyPanel(QWidget):
             target = [(current_layer, self.original_image)]
         
         # Apply process
-        current_focus = self.parent.get_focus_window()
+        command = self.command()
         for layer, image in target:
-            """ Process """
-            result = self.process_image(image)
-            
-            region = self.parent.get_result_by_roi(image, result, current_focus.selected_rect)
-            layer.set_image(region)
+            layer.set_image(command.run(image))
      
     def restore_layers(self):
         """
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
         
     def apply_btn_pressed(self):
         self.apply = True
         
         self.apply_on_layer()
+        self.parent.push_undo_command(self.command())
                    
         self.parent.display_current_image()
         self.close()
@@ -1416,6 +1392,8 @@ class MorphologyPanel(QWidget):
         self.parent.update_button_menu()
         event.accept()
 
+LayerCommand.register("morphology", MorphologyPanel.morph_image)
+
 
 """ Histogram Equalization Control Panel """
 class HistogramEqualizationPanel(QWidget):
@@ -1438,11 +1416,11 @@ class HistogramEqualizationPanel(QWidget):
         self.original_layer = []
         _, layers = self.parent.image_list[self.parent.current_index]
         for layer in layers:
-            self.original_layer.append((layer, layer.image.copy()))
+            self.original_layer.append((layer, layer.image))
         # Original current layer image
         self.original_image = self.parent.current_focus_layer_image()
         # Original composite image
-        self.original_composite_image  = LayerManager.compose_layers(layers)
+        self.original_composite_image  = self.parent.get_composite(self.parent.current_index).copy()
         
         
         
@@ -1691,9 +1669,7 @@ class HistogramEqualizationPanel(QWidget):
             cv2.polylines(hist_img, [pts], False, color, 1)
 
         # Display on QLabel
-        bytes_per_line = 3 * w
-        q_img = QImage(hist_img.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        self.hist_plot_label.setPixmap(QPixmap.fromImage(q_img))
+        self.hist_plot_label.setPixmap(ImageBridge.to_pixmap(hist_img))
 
     def process_image(self, image):
         method_idx = self.algo_group.checkedId()
@@ -1779,20 +1755,7 @@ class HistogramEqualizationPanel(QWidget):
         if img.dtype != np.uint8:
             img = cv2.convertScaleAbs(img)
 
-        if len(img.shape) == 2:
-            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-        elif len(img.shape) == 3:
-            if img.shape[2] == 3:     
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-        h, w, _ = img.shape
-            
-        bytes_per_line = img.strides[0]
-        q_img = QImage(
-            img.data, 
-            w, h, bytes_per_line, 
-            QImage.Format_RGBA8888
-        ).rgbSwapped()
-        pixmap = QPixmap.fromImage(q_img.copy())
+        pixmap = ImageBridge.to_pixmap(img)
         
         # Scale to fit label
         scaled = pixmap.scaled(
@@ -1826,7 +1789,7 @@ class HistogramEqualizationPanel(QWidget):
         Reverts layers to their state before the dialog opened
         """
         for layer, ori_img in self.original_layer:
-            layer.set_image(ori_img.copy())
+            layer.set_image(ori_img)
         self.parent.display_current_image()
         
     def apply_btn_pressed(self):
@@ -321,8 +321,7 @@ class HistogramWindow(QMainWindow):
 
         ori_img = self.parent.original_image_list[self.parent.current_index]
         # Current Image
-        _, layers = self.parent.image_list[self.parent.current_index]
-        mod_img = LayerManager.compose_layers(layers)
+        mod_img = self.parent.get_composite(self.parent.current_index)
 
         # 2. Calculate Data (Using robust method)
         data_orig = self.calc_data(ori_img)
@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+from PyQt5 import sip
+from PyQt5.QtGui import QImage, QPixmap
+
+
+"""
+Zero-copy Conversion between NumPy Image and QImage
+"""
+class ImageBridge:
+    """
+    Zero-copy conversion between NumPy image and QImage \n
+    Gray -> Grayscale8, BGR -> BGR888, BGRA -> ARGB32 (B, G, R, A bytes in little endian)
+    """
+
+    formats = {1: QImage.Format_Grayscale8, 3: QImage.Format_BGR888, 4: QImage.Format_ARGB32}
+
+    def to_qimage(image):
+        """
+        QImage on the memory of image, no pixels are copied \n
+        Rows may have gaps (crop of other image), the QImage keeps image alive
+        """
+        if image.dtype != np.uint8:
+            image = cv2.convertScaleAbs(image)
+
+        h, w = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+
+        # Pixels inside a row must be packed
+        if image.strides[-1] != 1 or (image.ndim == 3 and image.strides[1] != channels):
+            image = np.ascontiguousarray(image)
+
+        qimage = QImage(
+            sip.voidptr(image.ctypes.data), w, h, image.strides[0], ImageBridge.formats[channels]
+        )
+        # QImage does not own the memory
+        qimage.array = image
+        return qimage
+
+    def to_pixmap(image):
+        """ QPixmap of image, the only copy is made by Qt """
+        return QPixmap.fromImage(ImageBridge.to_qimage(image))
+
+    def to_array(qimage):
+        """
+        BGRA (or gray / BGR for Grayscale8 / BGR888) array on the memory of qimage \n
+        Converted once if qimage is in other format, the array keeps qimage alive
+        """
+        channels = next((c for c, f in ImageBridge.formats.items() if f == qimage.format()), None)
+        if channels is None:
+            qimage = qimage.convertToFormat(QImage.Format_ARGB32)
+            channels = 4
+
+        h, w = qimage.height(), qimage.width()
+        shape = (h, w) if channels == 1 else (h, w, channels)
+        strides = (qimage.bytesPerLine(), 1) if channels == 1 else (qimage.bytesPerLine(), channels, 1)
+        return np.asarray(QImageBuffer(qimage, shape, strides))
+
+
+"""
+Array Interface of QImage Memory
+"""
+class QImageBuffer:
+    """
+    Array interface of QImage memory, \n
+    kept as base of the array so the QImage lives with it
+    """
+    def __init__(self, qimage, shape, strides):
+        self.qimage = qimage
+        self.__array_interface__ = {
+            "shape": shape, "strides": strides, "typestr": "|u1",
+            "data": (int(qimage.bits()), False), "version": 3,
+        }
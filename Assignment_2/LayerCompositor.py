@@ -0,0 +1,171 @@
+from Assignment_2.LayerManager import LayerManager
+
+
+
+#/layer
+"""
+Keep the composite result of one document,
+only recompute the changed area of layers,
+shared by all views, tools and saving of the document
+"""
+class LayerCompositor:
+    """
+    Keep the composite result of one document, \n
+    only recompute the changed area of layers, \n
+    shared by all views, tools and saving of the document
+    """
+
+    # Too many small areas, combine into one bounding area
+    max_dirty_rects = 8
+    # Number of flattened results under layers kept in memory
+    max_below_cache = 4
+
+    def __init__(self, grid_size=20):
+        self.buffer = None
+        self.layer_state = []
+        # Checkerboard cell size of composite
+        self.grid_size = grid_size
+        
+        # Document version, increased every time the layers are found changed
+        self.version = 0
+        # Number of calls reused the result / recomputed the result
+        self.hits = 0
+        self.misses = 0
+
+        # {layer index: (state of layers below, composite under the layer)}
+        self.below_cache = {}
+        
+        # Composite of smaller pyramid level {level: LayerCompositor}
+        self.level_compositors = {}
+
+    def layer_signature(layer):
+        """ Layer properties which affect every pixel of composite """
+        return (
+            layer.uid, layer.shape, layer.visible, layer.opacity,
+            layer.blend_mode, layer.clipping_mask
+        )
+
+    def reset(self):
+        """ Force full composite on next call """
+        self.buffer = None
+        self.layer_state = []
+        self.below_cache = {}
+        self.level_compositors = {}
+
+    def compose(self, layers, level=0):
+        """
+        Composite result of all layers \n
+        level: composite the images downsampled by 2 ** level \n
+        Result is shared and never changed after returned, do not modify it
+        """
+        if not layers: return None
+        
+        if level > 0:
+            compositor = self.level_compositors.get(level)
+            if compositor is None:
+                compositor = LayerCompositor(max(1, self.grid_size >> level))
+                self.level_compositors[level] = compositor
+            return compositor.compose([l.level_layer(level) for l in layers])
+
+        state = [(LayerCompositor.layer_signature(l), l.version) for l in layers]
+        if self.buffer is not None and state == self.layer_state:
+            self.hits += 1
+            return self.buffer
+        self.misses += 1
+        self.version += 1
+
+        # Lowest changed layer, layers under it can reuse the cache
+        first = 0
+        while first < min(len(state), len(self.layer_state)) and \
+                state[first] == self.layer_state[first]:
+            first += 1
+        start, base = self.get_below_cache(state, first)
+        rects = self.get_dirty_rects(layers)
+
+        if rects is None:
+            # Keep the result under the changed layer for next editing
+            if start < first:
+                base = LayerManager.compose_layers(
+                    layers, start=start, stop=first, base=base, grid_size=self.grid_size
+                )
+                self.set_below_cache(state, first, base)
+            self.buffer = LayerManager.compose_layers(
+                layers, start=first, base=base, grid_size=self.grid_size
+            )
+        elif rects:
+            # Last result is handed out and never changed, write the changed areas on a copy
+            buffer = self.buffer.copy()
+            for x1, y1, x2, y2 in rects:
+                buffer[y1:y2, x1:x2] = LayerManager.compose_layers(
+                    layers, (x1, y1, x2, y2), start, base=base, grid_size=self.grid_size
+                )
+            self.buffer = buffer
+
+        self.layer_state = state
+        return self.buffer
+
+    def counters(self):
+        """
+        Reuse count of composite result \n
+        Return {level: (hits, misses)}
+        """
+        counters = {0: (self.hits, self.misses)}
+        for level, compositor in self.level_compositors.items():
+            counters[level] = (compositor.hits, compositor.misses)
+        return counters
+
+    def get_below_cache(self, state, index):
+        """
+        Nearest cached composite under layers[index] \n
+        Return (layer index, composite), (0, None) if not found
+        """
+        for i in sorted(self.below_cache, reverse=True):
+            below_state, image = self.below_cache[i]
+            if i > index: continue
+
+            # Layers under it changed
+            if below_state != state[:i]:
+                del self.below_cache[i]
+                continue
+
+            # Most recently used at the end
+            self.below_cache[i] = self.below_cache.pop(i)
+            return i, image
+        return 0, None
+
+    def set_below_cache(self, state, index, image):
+        if index <= 0: return
+
+        self.below_cache.pop(index, None)
+        self.below_cache[index] = (state[:index], image)
+        while len(self.below_cache) > LayerCompositor.max_below_cache:
+            del self.below_cache[next(iter(self.below_cache))]
+
+    def get_dirty_rects(self, layers):
+        """
+        Changed areas since last composite \n
+        Return None if need to composite whole canvas
+        """
+        if self.buffer is None: return None
+        if len(layers) != len(self.layer_state): return None
+        if self.buffer.shape[:2] != layers[0].shape[:2]: return None
+
+        rects = []
+        for layer, (signature, version) in zip(layers, self.layer_state):
+            if LayerCompositor.layer_signature(layer) != signature:
+                return None
+
+            layer_rects = layer.dirty_rects_since(version)
+            if layer_rects is None: return None
+            rects.extend(r for r in layer_rects if r[0] < r[2] and r[1] < r[3])
+
+        if len(rects) > LayerCompositor.max_dirty_rects:
+            rects = [LayerCompositor.union_rect(rects)]
+        return rects
+
+    def union_rect(rects):
+        """ Bounding area of all rects """
+        return (
+            min(r[0] for r in rects), min(r[1] for r in rects),
+            max(r[2] for r in rects), max(r[3] for r in rects)
+        )
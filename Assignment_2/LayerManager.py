@@ -1,15 +1,23 @@
 import os
 import copy
+import zlib
+import weakref
+import tempfile
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton,
-    QListWidget, QComboBox, QSlider, QAbstractItemView,
-    QListWidgetItem, QMessageBox, QInputDialog
+    QListView, QComboBox, QSlider, QAbstractItemView,
+    QMessageBox, QInputDialog
 )
-from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtCore import Qt, QSize, QAbstractListModel, QModelIndex, pyqtSignal
 from PyQt5.QtGui import QIcon, QImage, QPixmap, QCloseEvent
 
+from Assignment_2.ImageBridge import ImageBridge
+
 # from main import assets_path
 ## Path of assets folder loaded 
 current_path = os.path.dirname(os.path.abspath(__file__))
@@ -31,7 +39,663 @@ class LayerState:
         self.is_visible = is_visible
         self.blend_mode = blend_mode
         self.clipping_mask = clipping_mask
-        self.image_data = copy.deepcopy(image_data)
+        # Layer images are read-only, share it instead of copy
+        self._image_data = LayerManager.shared_image(image_data)
+        # Changed tiles (y, x, image) against layer base of next state
+        self.base = None
+        self.tiles = None
+        # Layer (weakref) and its pixel change log when taken, see Layer.make_state
+        self.layer = None
+        self.uid = None
+        self.version = None
+        self.dirty_log = None
+        # Old pixels {(y, x): tile} of the shared image written in place by the layer later
+        self.saved_tiles = None
+
+    @property
+    def image_data(self):
+        """
+        Whole image of the state, the tiles written in place by the layer are put back \n
+        Once read it may be kept, the layer stops writing its image in place
+        """
+        if self.saved_tiles:
+            image = self._image_data.copy()
+            for (y, x), tile in self.saved_tiles.items():
+                image[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+            self._image_data = LayerManager.shared_image(image, owned=True)
+        self.saved_tiles = None
+        
+        layer = self.layer() if self.layer is not None else None
+        if layer is not None:
+            layer.lend_image(self._image_data)
+        self.layer = None
+        return self._image_data
+
+    @image_data.setter
+    def image_data(self, image):
+        self._image_data = image
+        self.saved_tiles = None
+        self.layer = None
+
+    def save_tiles(self, rect):
+        """ Keep the tiles of the shared image under rect (x1, y1, x2, y2) before the layer writes them """
+        if self.saved_tiles is None: self.saved_tiles = {}
+        
+        for y, x in LayerHistory.rect_tiles(rect):
+            if (y, x) not in self.saved_tiles:
+                size = LayerHistory.tile_size
+                self.saved_tiles[(y, x)] = self._image_data[y:y + size, x:x + size].copy()
+
+"""
+Layer Property Change for Undo/Redo
+"""
+class LayerChange:
+    """
+    Property change of one layer, stored instead of pixels \n
+    changes: {attribute: (old value, new value)}, \n
+    "order" moves the layer from old index to new index
+    """
+    def __init__(self, index, **changes):
+        # Index of the layer before the change
+        self.index = index
+        self.changes = changes
+
+    def apply(self, layers):
+        """ Redo the change on layers, return index of the layer """
+        return self.set_values(layers, 1)
+
+    def revert(self, layers):
+        """ Undo the change on layers, return index of the layer """
+        return self.set_values(layers, 0)
+
+    def set_values(self, layers, side):
+        src, dst = self.changes.get("order", (self.index, self.index))
+        if side == 0: src, dst = dst, src
+
+        layer = layers[src]
+        if src != dst:
+            layers.insert(dst, layers.pop(src))
+
+        for name, values in self.changes.items():
+            if name != "order": setattr(layer, name, values[side])
+        return dst
+
+"""
+Invertible Layer Transform for Undo/Redo
+"""
+class LayerTransform:
+    """
+    Exactly invertible orientation change, stored instead of pixels \n
+    op: "flip_h", "flip_v", "rotate_cw", "rotate_ccw" or "rotate_180" \n
+    index: index of the layer, None for all layers
+    """
+
+    operations = {
+        "flip_h": lambda img: cv2.flip(img, 1),
+        "flip_v": lambda img: cv2.flip(img, 0),
+        "rotate_cw": lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+        "rotate_ccw": lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
+        "rotate_180": lambda img: cv2.rotate(img, cv2.ROTATE_180),
+    }
+    inverse = {
+        "flip_h": "flip_h", "flip_v": "flip_v", "rotate_180": "rotate_180",
+        "rotate_cw": "rotate_ccw", "rotate_ccw": "rotate_cw",
+    }
+    # Rotate type of menu (1, -1, 180) to operation
+    rotations = {1: "rotate_cw", -1: "rotate_ccw", 180: "rotate_180"}
+
+    def __init__(self, op, index=None):
+        self.op = op
+        self.index = index
+
+    def apply(self, layers):
+        """ Transform layers, return index of the layer, -1 for all layers """
+        return LayerTransform.transform_layers(layers, self.op, self.index)
+
+    def revert(self, layers):
+        """ Transform layers back, return index of the layer, -1 for all layers """
+        return LayerTransform.transform_layers(layers, LayerTransform.inverse[self.op], self.index)
+
+    def transform_layers(layers, op, index=None):
+        targets = layers if index is None else [layers[index]]
+        for layer in targets:
+            # Transform the stored format, no conversion loss
+            img = layer.premultiplied_image if layer.premultiplied else layer.image
+            img = LayerTransform.operations[op](img)
+            layer.set_image(
+                img, (0, 0, img.shape[1], img.shape[0]), premultiplied=layer.premultiplied
+            )
+        return -1 if index is None else index
+
+"""
+Replayable Layer Filter for Undo/Redo
+"""
+class LayerCommand:
+    """
+    Deterministic filter on layers, replayed from a keyframe for undo \n
+    operation: registered id, params: {name: value} of the operation, \n
+    index: index of the layer, None for all layers, \n
+    rect: (x1, y1, x2, y2) selected area, (0, 0, 0, 0) for whole layer
+    """
+
+    # {operation id: function(image, **params) -> image}
+    operations = {}
+
+    def __init__(self, operation, params, index=None, rect=(0, 0, 0, 0)):
+        self.operation = operation
+        self.params = params
+        self.index = index
+        self.rect = rect
+
+    def register(operation, function):
+        LayerCommand.operations[operation] = function
+
+    def run(self, image):
+        """ Result of the operation on image, only inside rect """
+        result = LayerCommand.operations[self.operation](image, **self.params)
+        return LayerCommand.apply_rect(image, result, self.rect)
+
+    def apply(self, layers):
+        """ Run on layers, return index of the layer, -1 for all layers """
+        targets = layers if self.index is None else [layers[self.index]]
+        for layer in targets:
+            layer.set_image(self.run(layer.image))
+        return -1 if self.index is None else self.index
+
+    def apply_rect(img, result, rect):
+        """
+        Apply the result, if there are ROI existing
+        """
+        if rect != (0, 0, 0, 0):
+            if len(img.shape) == 2:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+            elif len(img.shape) == 3:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+                
+            if len(result.shape) == 2:
+                result = cv2.cvtColor(result, cv2.COLOR_GRAY2BGRA)
+            elif len(result.shape) == 3:
+                result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
+            
+            x1, y1, x2, y2 = rect
+            h, w = result.shape[:2]
+            x1, x2 = max(0, min(x1, w)), max(0, min(x2, w))
+            y1, y2 = max(0, min(y1, h)), max(0, min(y2, h))
+            
+            region = img.copy()
+            region[y1:y2, x1:x2] = result[y1:y2, x1:x2]
+        else:
+            region = result
+        return region
+
+"""
+One State of Undo/Redo Stack
+"""
+class HistoryEntry:
+    """
+    One state of LayerHistory, [LayerState] and the memory it takes, \n
+    or a LayerChange / LayerTransform / LayerCommand without pixels, \n
+    a LayerCommand with layers keeps the keyframe before it \n
+    Stored pixels are compressed in background, spilled to disk over budget
+    """
+
+    # Order of entries among all documents, the oldest is spilled first
+    seq_counter = itertools.count()
+    # Sizes and stored data are written by the worker thread, read by enforce_budget
+    size_lock = threading.Lock()
+
+    def __init__(self, layers, change=None):
+        self.layers = layers
+        self.change = change
+        self.seq = next(HistoryEntry.seq_counter)
+
+        # Bytes of stored pixels kept in memory
+        self.nbytes = 0
+        # Compressed pixels and [(shape, dtype)] of the arrays in it
+        self.data = None
+        self.layout = None
+        # Scratch file of compressed pixels, on_disk is set once spill is scheduled
+        self.path = None
+        self.on_disk = False
+        self.disk_bytes = 0
+        # Last background job of the entry
+        self.future = None
+
+    def store_delta(self, newer):
+        """ Keep only the tiles which differ from newer [LayerState], compressed in background """
+        self.layers = LayerHistory.make_delta(self.layers, newer)
+        self.nbytes = sum(a.nbytes for a in self.stored_arrays())
+        self.future = LayerHistory.get_executor().submit(self.pack)
+
+    def stored_arrays(self):
+        """ Pixels kept by the states, changed tiles or whole images """
+        arrays = []
+        for state in self.layers:
+            if state.base is not None:
+                arrays.extend(tile for _, _, tile in state.tiles)
+            else:
+                arrays.append(state.image_data)
+        return arrays
+
+    def pack(self):
+        """ Compress the stored pixels, run in background """
+        arrays = self.stored_arrays()
+        compressor = zlib.compressobj(LayerHistory.compress_level)
+        chunks = [compressor.compress(np.ascontiguousarray(a)) for a in arrays]
+        chunks.append(compressor.flush())
+
+        data = b"".join(chunks)
+        for state in self.layers:
+            if state.base is not None:
+                state.tiles = [(y, x, None) for y, x, _ in state.tiles]
+            else:
+                state.image_data = None
+        
+        with HistoryEntry.size_lock:
+            self.data = data
+            self.layout = [(a.shape, a.dtype.str) for a in arrays]
+            self.nbytes = len(data)
+
+    def spill(self, directory):
+        """ Move compressed pixels to a scratch file, run in background """
+        fd, path = tempfile.mkstemp(suffix=".undo", dir=directory)
+        with os.fdopen(fd, "wb") as file:
+            file.write(self.data)
+
+        with HistoryEntry.size_lock:
+            self.path = path
+            self.data = None
+            self.nbytes = 0
+
+    def unpack(self):
+        """ Bring the stored pixels back into the states """
+        self.wait()
+        if self.layout is None: return
+
+        data = self.data
+        if self.path is not None:
+            with open(self.path, "rb") as file:
+                data = file.read()
+            self.discard()
+        raw = zlib.decompress(data)
+
+        arrays, offset = [], 0
+        for shape, dtype in self.layout:
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            arrays.append(np.frombuffer(raw, dtype, count, offset).reshape(shape))
+            offset += count * dtype.itemsize
+
+        arrays = iter(arrays)
+        for state in self.layers:
+            if state.base is not None:
+                state.tiles = [(y, x, next(arrays)) for y, x, _ in state.tiles]
+            else:
+                state.image_data = LayerManager.shared_image(next(arrays))
+
+        with HistoryEntry.size_lock:
+            self.data = self.layout = None
+            self.nbytes = sum(a.nbytes for a in self.stored_arrays())
+
+    def wait(self):
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def discard(self):
+        """ Remove the scratch file """
+        self.wait()
+        if self.path is not None:
+            try: os.remove(self.path)
+            except OSError: pass
+        self.path = None
+        self.on_disk = False
+        self.disk_bytes = 0
+
+"""
+Undo/Redo Stack of One Document
+"""
+class LayerHistory:
+    """
+    Undo/Redo stack of one document, list of [LayerState], \n
+    LayerChange, LayerTransform or LayerCommand \n
+    Only the newest state keeps whole images, \n
+    older states keep the tiles differ from the newer state
+    """
+
+    # Side length of the compared and stored tiles
+    tile_size = 64
+    # zlib level of stored pixels, 1 is the fastest
+    compress_level = 1
+    # Memory of older states among all documents before spilled to disk,
+    # the newest states are not counted, they share images with layers
+    memory_budget = 512 * 1024 ** 2
+    # Disk space of spilled states before the oldest are removed
+    disk_budget = 4 * 1024 ** 3
+    # Folder of spilled states, temporary folder if None
+    scratch_dir = None
+    # Log filters as LayerCommand, replayed from a keyframe for undo
+    command_log = True
+    # Longest replay of commands before a new keyframe is kept
+    keyframe_interval = 8
+
+    histories = weakref.WeakSet()
+    scratch = None
+    executor = None
+    executor_lock = threading.Lock()
+
+    def __init__(self):
+        self.entries = []
+        # Command keyframe kept whole while the next command may drop the newest state
+        self.keyframe = None
+        LayerHistory.histories.add(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        for entry in self.entries:
+            entry.discard()
+        self.entries = []
+        self.keyframe = None
+
+    def append(self, layers):
+        """ layers: [LayerState] of all layers, or LayerChange / LayerTransform """
+        if not isinstance(layers, list):
+            self.entries.append(HistoryEntry(None, layers))
+            return
+
+        entry = self.newest_snapshot()
+        # State after the keyframe is kept, store the keyframe as tiles now
+        if self.keyframe is not None:
+            self.keyframe.store_delta(self.layers_before(self.keyframe, entry.layers, entry))
+            self.keyframe = None
+
+        if entry is not None:
+            # Same condition as attach_command, a command logged next drops the new state
+            steps = len(self.entries) - self.entries.index(entry)
+            if LayerHistory.command_log and isinstance(entry.change, LayerCommand) and \
+                    steps < LayerHistory.keyframe_interval:
+                self.keyframe = entry
+                entry.nbytes = LayerHistory.unshared_bytes(entry.layers, layers)
+            else:
+                entry.store_delta(self.layers_before(entry, layers))
+
+        self.entries.append(HistoryEntry(layers))
+        LayerHistory.enforce_budget()
+
+    def pop(self, index=-1):
+        """
+        Remove the newest (index -1) or oldest (index 0) state \n
+        Return the change, or [LayerState] with whole images for the newest state
+        """
+        entry = self.entries.pop(index)
+        if index != -1:
+            entry.discard()
+            if entry is self.keyframe: self.keyframe = None
+            
+            # Commands after the keyframe can not replay without it
+            if index == 0:
+                count = next(
+                    (i for i, e in enumerate(self.entries) if e.layers is not None), len(self.entries)
+                )
+                if any(isinstance(e.change, LayerCommand) for e in self.entries[:count]):
+                    del self.entries[:count]
+            return entry.change or entry.layers
+
+        if entry.layers is not None:
+            older = self.newest_snapshot()
+            if older is not None and older is self.keyframe:
+                # Keyframe is still whole
+                self.keyframe = None
+            elif older is not None:
+                older.unpack()
+                older.layers = LayerHistory.apply_delta(older.layers, self.layers_before(older, entry.layers))
+                older.nbytes = 0
+        return entry.change or entry.layers
+
+    def attach_command(self, command):
+        """
+        Log command on the newest state saved before it, \n
+        its pixels are dropped if a recent keyframe can replay to it
+        """
+        steps = None
+        for i, entry in enumerate(reversed(self.entries[:-1])):
+            if entry.layers is None: continue
+            if isinstance(entry.change, LayerCommand): steps = i + 1
+            break
+
+        if LayerHistory.command_log and steps is not None and steps < LayerHistory.keyframe_interval:
+            keyframe = self.keyframe
+            newer = self.pop()
+            self.entries.append(HistoryEntry(None, command))
+            
+            # Layers changed by the command no longer share the keyframe images
+            if keyframe is not None and self.keyframe is None and isinstance(newer, list):
+                kept = [s for i, s in enumerate(newer) if command.index not in (None, i)]
+                keyframe.nbytes = LayerHistory.unshared_bytes(keyframe.layers, kept)
+                LayerHistory.enforce_budget()
+        else:
+            self.entries[-1].change = command
+
+    def replay_base(self):
+        """
+        State before the newest command \n
+        Return (keyframe [LayerState], [changes to apply after the keyframe])
+        """
+        changes = []
+        for entry in reversed(self.entries):
+            if entry is not self.entries[-1]:
+                changes.insert(0, entry.change)
+            if entry.layers is not None:
+                return entry.layers, changes
+        return None, changes
+
+    def newest_change(self):
+        """ LayerChange / LayerTransform of the newest state, None if it stores layers """
+        if not self.entries: return None
+        return self.entries[-1].change
+
+    def newest_snapshot(self):
+        """ Newest state which stores layers """
+        for entry in reversed(self.entries):
+            if entry.layers is not None: return entry
+        return None
+
+    def enforce_budget():
+        """
+        Spill the oldest states to disk over memory budget, \n
+        remove the oldest spilled states over disk budget
+        """
+        entries = sorted(
+            ((entry, history) for history in list(LayerHistory.histories)
+                for entry in history.entries[:-1]),
+            key=lambda item: item[0].seq
+        )
+
+        # Entries still compressing count their raw pixels
+        with HistoryEntry.size_lock:
+            sizes = {entry: (entry.nbytes, entry.data is not None) for entry, _ in entries}
+
+        memory = sum(sizes[entry][0] for entry, _ in entries if not entry.on_disk)
+        for entry, history in entries:
+            if memory <= LayerHistory.memory_budget: break
+            
+            # Only compressed pixels are spilled, their size on disk is known
+            nbytes, packed = sizes[entry]
+            if entry.on_disk or not packed or entry is history.keyframe: continue
+
+            memory -= nbytes
+            entry.on_disk = True
+            entry.disk_bytes = nbytes
+            entry.future = LayerHistory.get_executor().submit(
+                entry.spill, LayerHistory.get_scratch_dir()
+            )
+
+        # Spilled states are always the oldest of their stack
+        disk = sum(entry.disk_bytes for entry, _ in entries if entry.on_disk)
+        for entry, history in entries:
+            if disk <= LayerHistory.disk_budget: break
+            if not entry.on_disk or history.entries[0] is not entry: continue
+
+            disk -= entry.disk_bytes
+            history.pop(0)
+
+    def get_executor():
+        """ Single worker thread, jobs of one entry run in order """
+        with LayerHistory.executor_lock:
+            if LayerHistory.executor is None:
+                LayerHistory.executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="history_pack"
+                )
+            return LayerHistory.executor
+
+    def get_scratch_dir():
+        if LayerHistory.scratch_dir is not None:
+            os.makedirs(LayerHistory.scratch_dir, exist_ok=True)
+            return LayerHistory.scratch_dir
+
+        # Removed when the program exits
+        if LayerHistory.scratch is None:
+            LayerHistory.scratch = tempfile.TemporaryDirectory(prefix="undo_")
+        return LayerHistory.scratch.name
+
+    def layers_before(self, entry, newer, end=None):
+        """
+        newer [LayerState] in the layout of entry, the layer moves and LayerTransform \n
+        logged after entry (until end) are reverted, so the delta to entry stays in small tiles
+        """
+        start = self.entries.index(entry) + 1
+        stop = len(self.entries) if end is None else self.entries.index(end)
+        changes = [e.change for e in self.entries[start:stop]]
+        if not any(isinstance(change, LayerTransform) for change in changes): return newer
+
+        newer = [copy.copy(state) for state in newer]
+        for change in reversed(changes):
+            if isinstance(change, LayerChange) and "order" in change.changes:
+                src, dst = change.changes["order"]
+                newer.insert(src, newer.pop(dst))
+            elif isinstance(change, LayerTransform):
+                op = LayerTransform.operations[LayerTransform.inverse[change.op]]
+                for state in (newer if change.index is None else [newer[change.index]]):
+                    state.image_data = LayerManager.shared_image(op(state.image_data), owned=True)
+        return newer
+
+    def unshared_bytes(layers, newer):
+        """ Bytes of the whole images of layers which are not shared with newer """
+        shared = {id(s._image_data) for s in newer}
+        return sum(
+            s._image_data.nbytes for s in layers
+            if s.base is None and s._image_data is not None and id(s._image_data) not in shared
+        )
+
+    def make_delta(layers, newer):
+        """
+        Keep only the tiles of layers which differ from newer \n
+        States of the same layer compare only the areas in its change log
+        """
+        result = []
+        for i, state in enumerate(layers):
+            # Images of newer are read without lending, they are still tracked by the layers
+            image, saved = state._image_data, state.saved_tiles or {}
+            state = copy.copy(state)
+            state.image_data = None
+
+            # Same shared buffer, only the tiles written in place may differ
+            base = next((j for j, s in enumerate(newer) if s._image_data is image), None)
+            if base is not None:
+                state.base = base
+                state.tiles = [
+                    (y, x, tile) for (y, x), tile in saved.items()
+                    if not np.array_equal(tile, image[y:y + tile.shape[0], x:x + tile.shape[1]])
+                ]
+            elif i < len(newer) and newer[i]._image_data.shape == image.shape:
+                size = LayerHistory.tile_size
+                image = layers[i].image_data
+                state.base = i
+                # Copy tiles, views would keep the whole image alive
+                state.tiles = [
+                    (y, x, image[y:y + size, x:x + size].copy())
+                    for y, x in LayerHistory.changed_tiles(
+                        image, newer[i]._image_data, LayerHistory.changed_rects(layers[i], newer[i])
+                    )
+                ]
+            else:
+                state.image_data = layers[i].image_data
+
+            result.append(state)
+        return result
+
+    def apply_delta(layers, newer):
+        """ Rebuild whole images of layers from newer and the stored tiles """
+        result = []
+        for state in layers:
+            if state.base is None:
+                result.append(state)
+                continue
+
+            image = newer[state.base].image_data
+            if state.tiles:
+                image = image.copy()
+                for y, x, tile in state.tiles:
+                    image[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+
+            state = copy.copy(state)
+            state.image_data = LayerManager.shared_image(image, owned=True)
+            state.base, state.tiles = None, None
+            result.append(state)
+        return result
+
+    def changed_rects(state, newer):
+        """
+        Areas (x1, y1, x2, y2) changed between two states of the same layer \n
+        Return None if unknown (other layer, or the change log is not enough)
+        """
+        if state.uid is None or state.uid != newer.uid: return None
+        
+        # Redo stack keeps the later versions first
+        older, newer = sorted((state, newer), key=lambda s: s.version)
+        if older.version == newer.version: return []
+        if not newer.dirty_log or newer.dirty_log[0][0] > older.version + 1:
+            return None
+        return [rect for v, rect in newer.dirty_log if v > older.version]
+
+    def rect_tiles(rect):
+        """ Top left (y, x) of tiles under rect (x1, y1, x2, y2) """
+        size = LayerHistory.tile_size
+        x1, y1, x2, y2 = rect
+        return [
+            (y, x) for y in range(y1 // size * size, y2, size)
+            for x in range(x1 // size * size, x2, size)
+        ]
+
+    def changed_tiles(image, other, rects=None):
+        """
+        Top left (y, x) of tiles where image and other are different \n
+        rects: compare only the tiles under these areas (x1, y1, x2, y2), whole image if None
+        """
+        size = LayerHistory.tile_size
+        h, w = image.shape[:2]
+        if rects is None: rects = [(0, 0, w, h)]
+
+        tiles = set()
+        for x1, y1, x2, y2 in rects:
+            if x1 >= x2 or y1 >= y2: continue
+            
+            # Whole tiles around the rect
+            x1, y1 = x1 // size * size, y1 // size * size
+            x2, y2 = min(-(-x2 // size) * size, w), min(-(-y2 // size) * size, h)
+            
+            diff = image[y1:y2, x1:x2] != other[y1:y2, x1:x2]
+            if diff.ndim == 3: diff = diff.any(axis=2)
+
+            rows, cols = -(-(y2 - y1) // size), -(-(x2 - x1) // size)
+            grid = np.zeros((rows * size, cols * size), dtype=bool)
+            grid[:y2 - y1, :x2 - x1] = diff
+            grid = grid.reshape(rows, size, cols, size).any(axis=(1, 3))
+
+            tiles.update((y1 + y * size, x1 + x * size) for y, x in zip(*np.nonzero(grid)))
+        return sorted(tiles)
 
 """
 Single Layer Information Object
@@ -41,26 +705,446 @@ class Layer:
     Single Layer Information Object
     """
     
+    # Maximum dirty rectangles remembered before fall back to full redraw
+    max_dirty_log = 32
+    # Unique id for each layer object (id() may reuse after deleted)
+    uid_counter = itertools.count()
+    
     def __init__(self, parent, 
                  name, image_data, visible=True, opacity=1.0, blend_mode="Normal", clipping_mask=False):
         
         self.parent = parent
         self.name = name
+        self.uid = next(Layer.uid_counter)
+        
+        # Pixel change tracking (version, dirty rect)
+        self.version = 0
+        self.dirty_log = []
+        # Bounding box of non-transparent pixels (version, rect)
+        self.content_cache = None
+        
+        # Store color multiplied by alpha, straight alpha image made when needed
+        self.premultiplied = LayerManager.premultiplied_storage
+        self.straight_cache = None
+        
+        # Downsampled images 1/2, 1/4, 1/8 ... {level: (version, image)}
+        self.pyramid_cache = {}
+        # Undo states taken from layer (weakref), they may share the image
+        self.states = []
+        # Image or straight cache may be kept by others than the states, never written in place
+        self.image_lent = True
+        self.straight_lent = False
+        
         # Ensure image is BGRA (has transparency)
-        self.image = image_data.copy()
         if image_data.shape[2] == 3:
             self.image = cv2.cvtColor(image_data, cv2.COLOR_BGR2BGRA)
+        else:
+            self.image = LayerManager.shared_image(image_data)
             
         self.visible = visible
         self.opacity = opacity
         self.blend_mode = blend_mode
         self.clipping_mask = clipping_mask
     
-    def set_image(self, img):
-        self.image = img.copy()
+    @property
+    def image(self):
+        """
+        Straight alpha image of layer \n
+        Read-only and shared, copy it before editing
+        """
+        return self.lend_image(self.peek_image())
+    
+    @image.setter
+    def image(self, img):
+        """ Direct assignment, treat as whole layer changed, layer takes the image """
+        new_img = LayerManager.premultiply(img) if self.premultiplied else img
+        self._image = LayerManager.shared_image(new_img, owned=True)
+        # Caller may still keep the image
+        self.image_lent = self._image is img
+        self.mark_dirty()
+    
+    def peek_image(self):
+        """
+        Straight alpha image of layer, only to read during the call \n
+        Unlike image it must not be kept (or views of it), patch_image may write it later
+        """
+        if not self.premultiplied: return self._image
+        
+        if self.straight_cache is None or self.straight_cache[0] != self.version:
+            straight = LayerManager.unpremultiply(self._image)
+            self.straight_cache = (self.version, LayerManager.shared_image(straight, owned=True))
+            self.straight_lent = False
+        return self.straight_cache[1]
+    
+    def lend_image(self, image):
+        """ Image of layer is handed out and may be kept, it is copied before the next write """
+        if image is self._image:
+            self.image_lent = True
+        elif self.straight_cache is not None and image is self.straight_cache[1]:
+            self.straight_lent = True
+        return image
+    
+    @property
+    def shape(self):
+        """ Image shape, without converting the storage """
+        return self._image.shape
+    
+    @property
+    def premultiplied_image(self):
+        """ Premultiplied alpha image of layer """
+        if self.premultiplied: return self.lend_image(self._image)
+        return LayerManager.premultiply(self._image)
+    
+    def set_image(self, img, rect=None, premultiplied=False):
+        """
+        Replace layer image, img becomes read-only and shared by layer \n
+        rect: (x1, y1, x2, y2) changed area, detect by difference if not given \n
+        premultiplied: img color is already multiplied by alpha
+        """
+        old_img = self._image
+        
+        # Image edited in place, unable to find the difference
+        if rect is None and (np.may_share_memory(old_img, img) or 
+                (self.straight_cache is not None and np.may_share_memory(self.straight_cache[1], img))):
+            rect = (0, 0, img.shape[1], img.shape[0])
+        
+        new_img = img
         if img.shape[2] == 3:
-            self.image = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+            new_img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+        
+        # Convert to the storage format
+        if self.premultiplied and not premultiplied:
+            new_img = LayerManager.premultiply(new_img)
+        elif premultiplied and not self.premultiplied:
+            new_img = LayerManager.unpremultiply(new_img)
+        
+        # Layer takes the image, copy only if it is part of other image
+        self._image = LayerManager.shared_image(new_img, owned=True)
+        self.image_lent = self._image is img
+        
+        if rect is None:
+            rect = LayerManager.changed_rect(old_img, self._image)
+            if rect != (0, 0, 0, 0):
+                self.mark_dirty(rect)
+        else:
+            self.mark_dirty(rect)
+        self.parent.on_image_changed()
+    
+    def patch_image(self, patch, rect, premultiplied=False):
+        """
+        Replace area rect (x1, y1, x2, y2) of layer image with patch, rect must be inside the image \n
+        Only the patch is converted, the rest of the image is copied as it is \n
+        premultiplied: patch color is already multiplied by alpha
+        """
+        x1, y1, x2, y2 = rect
+        if patch.shape[2] == 3:
+            patch = cv2.cvtColor(patch, cv2.COLOR_BGR2BGRA)
+        
+        # Convert to the storage format
+        if self.premultiplied and not premultiplied:
+            patch = LayerManager.premultiply(patch)
+        elif premultiplied and not self.premultiplied:
+            patch = LayerManager.unpremultiply(patch)
+        
+        # Straight alpha image is still valid outside rect, update only the patch
+        straight = None
+        if self.premultiplied and self.straight_cache is not None and self.straight_cache[0] == self.version:
+            straight = self.writable_image(self.straight_cache[1], self.straight_lent, rect)
+            straight[y1:y2, x1:x2] = LayerManager.unpremultiply(patch)
+        
+        new_img = self.writable_image(self._image, self.image_lent, rect)
+        new_img[y1:y2, x1:x2] = patch
+        self._image = LayerManager.shared_image(new_img, owned=True)
+        self.image_lent = False
+        self.mark_dirty(rect)
+        
+        if straight is not None:
+            self.straight_cache = (self.version, LayerManager.shared_image(straight, owned=True))
+            self.straight_lent = False
         self.parent.on_image_changed()
+    
+    def writable_image(self, image, lent, rect):
+        """
+        Image of layer (stored or straight cache) to write area rect in \n
+        A copy if it was lent, otherwise written in place after the undo states sharing it keep the old tiles
+        """
+        if lent or image.base is not None: return image.copy()
+        
+        for ref in self.states:
+            state = ref()
+            if state is not None and state._image_data is image:
+                state.save_tiles(rect)
+        image.flags.writeable = True
+        return image
+    
+    def make_state(self):
+        """
+        Undo state of layer sharing its image, tracked by layer \n
+        Undo compares only the changed areas, patch_image saves the old tiles into it before writing
+        """
+        state = LayerState(
+            self.name, self.opacity, self.visible, self.blend_mode, self.clipping_mask, self.peek_image()
+        )
+        state.layer = weakref.ref(self)
+        state.uid, state.version = self.uid, self.version
+        state.dirty_log = list(self.dirty_log)
+        
+        self.states = [ref for ref in self.states if ref() is not None]
+        self.states.append(weakref.ref(state))
+        return state
+    
+    def level_image(self, level):
+        """
+        Stored image downsampled by 2 ** level \n
+        Kept for next call, only the changed areas are updated
+        """
+        if level <= 0: return self.lend_image(self._image)
+        
+        cached = self.pyramid_cache.get(level)
+        if cached is not None and cached[0] == self.version: return cached[1]
+        
+        src = self._image if level == 1 else self.level_image(level - 1)
+        h, w = src.shape[:2]
+        
+        dirty_rects = None
+        if cached is not None and cached[1].shape[:2] == ((h + 1) // 2, (w + 1) // 2):
+            dirty_rects = self.dirty_rects_since(cached[0])
+        
+        if dirty_rects is None:
+            image = LayerManager.downsample(src)
+        else:
+            image = cached[1].copy()
+            for rect in dirty_rects:
+                x1, y1, x2, y2 = LayerManager.scale_rect(rect, level)
+                if x1 >= x2 or y1 >= y2: continue
+                image[y1:y2, x1:x2] = LayerManager.downsample(src[y1 * 2:y2 * 2, x1 * 2:x2 * 2])
+        
+        self.pyramid_cache[level] = (self.version, image)
+        return image
+    
+    def level_layer(self, level):
+        """
+        Lightweight copy of layer with the image of pyramid level, \n
+        for compositing in smaller size
+        """
+        if level <= 0: return self
+        
+        layer = copy.copy(self)
+        layer._image = self.level_image(level)
+        layer.straight_cache = None
+        layer.pyramid_cache = {}
+        layer.dirty_log = [(v, LayerManager.scale_rect(r, level)) for v, r in self.dirty_log]
+        layer.content_cache = (self.version, LayerManager.scale_rect(self.content_rect(), level))
+        return layer
+    
+    def set_premultiplied(self, premultiplied):
+        """ Change storage format of layer image """
+        if premultiplied == self.premultiplied: return
+        
+        img = self.image
+        self.premultiplied = premultiplied
+        self.straight_cache = None
+        self.image = img
+    
+    def mark_dirty(self, rect=None):
+        """
+        Record the changed area of layer \n
+        rect: (x1, y1, x2, y2), None for whole layer
+        """
+        h, w = self._image.shape[:2]
+        if rect is None:
+            rect = (0, 0, w, h)
+        else:
+            x1, y1, x2, y2 = rect
+            rect = (max(0, min(x1, w)), max(0, min(y1, h)), 
+                    max(0, min(x2, w)), max(0, min(y2, h)))
+        
+        self.version += 1
+        self.dirty_log.append((self.version, rect))
+        if len(self.dirty_log) > Layer.max_dirty_log:
+            self.dirty_log.pop(0)
+    
+    def dirty_rects_since(self, version):
+        """
+        Changed areas after given version \n
+        Return None if the history is not enough (Treat as whole layer)
+        """
+        if version == self.version: return []
+        if not self.dirty_log or self.dirty_log[0][0] > version + 1:
+            return None
+        return [rect for v, rect in self.dirty_log if v > version]
+    
+    def content_rect(self):
+        """
+        Bounding box (x1, y1, x2, y2) of non-transparent pixels \n
+        (0, 0, 0, 0) if the layer is empty
+        """
+        if self.content_cache is not None:
+            version, rect = self.content_cache
+            if version == self.version: return rect
+            
+            # Only look into the changed areas
+            dirty_rects = self.dirty_rects_since(version)
+            if dirty_rects is not None:
+                for dirty in dirty_rects:
+                    # Whole content redrawn, the box may become smaller
+                    if LayerManager.intersect_rect(rect, dirty) == rect:
+                        rect = (0, 0, 0, 0)
+                    rect = LayerManager.union_rect(rect, LayerManager.alpha_bounds(self._image, dirty))
+                self.content_cache = (self.version, rect)
+                return rect
+        
+        h, w = self._image.shape[:2]
+        rect = LayerManager.alpha_bounds(self._image, (0, 0, w, h))
+        self.content_cache = (self.version, rect)
+        return rect
+
+"""
+Layer List Model of Layer Panel
+"""
+class LayerListModel(QAbstractListModel):
+    """
+    Rows of the panel layers, top layer first \n
+    sync() compares layers with the listed rows, only the changes are signaled
+    """
+    def __init__(self, panel):
+        super().__init__(panel)
+        self.panel = panel
+        # Listed layers and the signature of each row when it was drawn
+        self.listed = []
+        self.signatures = []
+
+    def signature(layer):
+        """ Everything a row shows of layer """
+        return (
+            layer.name, layer.blend_mode, layer.opacity, 
+            layer.clipping_mask, layer.visible, layer.version
+        )
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.listed)
+
+    def layer_at(self, row):
+        return self.listed[row] if 0 <= row < len(self.listed) else None
+
+    def row_of(self, layer):
+        for row, listed in enumerate(self.listed):
+            if listed is layer: return row
+        return -1
+
+    def data(self, index, role=Qt.DisplayRole):
+        layer = self.layer_at(index.row())
+        if layer is None: return None
+        
+        if role == Qt.DisplayRole:
+            clipping_mask = "  ↳ " if layer.clipping_mask else ""
+            return f"{clipping_mask}{layer.name} \n({layer.blend_mode}) \n"\
+                   f"{int(layer.opacity*100)}%"
+        if role == Qt.DecorationRole:
+            # Only asked for the rows on screen
+            return self.panel.generate_layer_thumbnail(layer)
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if layer.visible else Qt.Unchecked
+        if role == Qt.UserRole:
+            return layer
+        return None
+
+    def flags(self, index):
+        if not index.isValid(): return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        layer = self.layer_at(index.row())
+        if layer is None or role != Qt.CheckStateRole: return False
+        
+        self.panel.set_layer_visible(layer, value == Qt.Checked)
+        return True
+
+    def reset_rows(self):
+        """ List layers of other document """
+        self.beginResetModel()
+        self.listed = list(reversed(self.panel.layers))
+        self.signatures = [LayerListModel.signature(layer) for layer in self.listed]
+        self.endResetModel()
+
+    def sync(self):
+        """ Update rows to the panel layers, signal removed, inserted, moved and changed rows """
+        layers = list(reversed(self.panel.layers))
+        
+        # Removed layers
+        alive = set(map(id, layers))
+        for row in reversed(range(len(self.listed))):
+            if id(self.listed[row]) in alive: continue
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.listed[row]
+            del self.signatures[row]
+            self.endRemoveRows()
+        
+        # Longest run of rows already in order stays, other rows are moved
+        target = {id(layer): row for row, layer in enumerate(layers)}
+        staying = LayerListModel.ordered_rows([target[id(layer)] for layer in self.listed])
+        staying = set(id(self.listed[row]) for row in staying)
+        
+        # New and moved layers, rows above are already in order
+        for row, layer in enumerate(layers):
+            if row < len(self.listed) and self.listed[row] is layer: continue
+            
+            if self.row_of(layer) == -1:
+                self.beginInsertRows(QModelIndex(), row, row)
+                self.listed.insert(row, layer)
+                self.signatures.insert(row, LayerListModel.signature(layer))
+                self.endInsertRows()
+                continue
+            
+            # Moved rows in the way are parked at the end until their place is reached
+            while self.listed[row] is not layer and id(self.listed[row]) not in staying:
+                self.move_row(row, len(self.listed))
+            if self.listed[row] is not layer:
+                self.move_row(self.row_of(layer), row)
+        
+        # Changed layers
+        for row, layer in enumerate(self.listed):
+            if LayerListModel.signature(layer) != self.signatures[row]:
+                self.refresh_row(row)
+
+    def ordered_rows(positions):
+        """ Rows of the longest increasing subsequence of positions """
+        # tails[k]: row ending the best run of length k + 1
+        tails, previous = [], [-1] * len(positions)
+        for row, position in enumerate(positions):
+            low, high = 0, len(tails)
+            while low < high:
+                mid = (low + high) // 2
+                if positions[tails[mid]] < position: low = mid + 1
+                else: high = mid
+            previous[row] = tails[low - 1] if low > 0 else -1
+            if low == len(tails): tails.append(row)
+            else: tails[low] = row
+        
+        rows = []
+        row = tails[-1] if tails else -1
+        while row != -1:
+            rows.append(row)
+            row = previous[row]
+        return rows
+
+    def move_row(self, src, dst):
+        """ Move row src to before row dst (dst in rows before the move) """
+        # Refused if the row stays in place
+        if not self.beginMoveRows(QModelIndex(), src, src, QModelIndex(), dst): return
+        self.listed.insert(dst if dst < src else dst - 1, self.listed.pop(src))
+        self.signatures.insert(dst if dst < src else dst - 1, self.signatures.pop(src))
+        self.endMoveRows()
+
+    def refresh_layer(self, layer):
+        """ Redraw the row of layer """
+        row = self.row_of(layer)
+        if row != -1: self.refresh_row(row)
+
+    def refresh_row(self, row):
+        self.signatures[row] = LayerListModel.signature(self.listed[row])
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
 
 """
 Layer Panel UI for managing and display multiple layers
@@ -69,6 +1153,14 @@ class LayersPanel(QWidget):
     """
     Layer Panel UI for managing and display multiple layers
     """
+    
+    ## Layer Thumbnails
+    # Generate icons in a worker thread, False to generate when requested
+    background_thumbnails = True
+    thumbnail_executor = None
+    thumbnail_executor_lock = threading.Lock()
+    # Finished thumbnail job (future), emitted by the worker thread, received in GUI thread
+    thumbnail_ready = pyqtSignal(object)
 
     def __init__(self, parent):
         super().__init__()
@@ -79,6 +1171,11 @@ class LayersPanel(QWidget):
         
         self.image_buffer = None
         self.image_changed = False
+        
+        # Icons {layer: (version, icon)}, icons in progress {layer: (version, future)}
+        self.thumbnails = weakref.WeakKeyDictionary()
+        self.thumbnail_jobs = weakref.WeakKeyDictionary()
+        self.thumbnail_ready.connect(self.collect_thumbnail)
         self.init_ui()
 
     def init_ui(self):
@@ -159,18 +1256,23 @@ class LayersPanel(QWidget):
     # Layer List
         layout.addWidget(QLabel("<b>Layers</b>"))
         
-        self.list_widget = QListWidget()
-        self.list_widget.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.list_model = LayerListModel(self)
+        self.list_view = QListView()
+        self.list_view.setModel(self.list_model)
+        self.list_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.list_view.setIconSize(QSize(40, 60))
+        # Rows look alike, layout does not ask every row for its size
+        self.list_view.setUniformItemSizes(True)
         
-        # Enable Drag and Drop
-        self.list_widget.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.list_view.setFocusPolicy(Qt.FocusPolicy.NoFocus)
         
         # Connect signals
-        self.list_widget.currentRowChanged.connect(self.set_active_layer)
-        self.list_widget.itemChanged.connect(self.on_item_changed)
-        self.list_widget.itemDoubleClicked.connect(self.rename_layer)
+        self.list_view.selectionModel().currentRowChanged.connect(
+            lambda current, previous: self.set_active_layer(current.row())
+        )
+        self.list_view.doubleClicked.connect(self.rename_layer)
         
-        layout.addWidget(self.list_widget)
+        layout.addWidget(self.list_view)
 
         self.setLayout(layout)
 
@@ -180,39 +1282,30 @@ class LayersPanel(QWidget):
         """ Update layers list """
         self.on_image_changed()
         self.layers = layers_list
+        
+        self._updating_ui = True
+        self.list_model.reset_rows()
+        self._updating_ui = False
         self.refresh_list(reset)
 
     def refresh_list(self, reset=False, index=-1):
-        """ Update layer panel list on main canvas """
+        """ Update layer panel list on main canvas, only the changed rows are redrawn """
         self._updating_ui = True 
-        self.list_widget.clear()
-        
-        for i, layer in enumerate(reversed(self.layers)): 
-            item = QListWidgetItem("layer")
-
-
-            item.setFlags(item.flags() | Qt.ItemIsUserCheckable | Qt.ItemIsDragEnabled | Qt.ItemIsDropEnabled)
-            item.setCheckState(Qt.Checked if layer.visible else Qt.Unchecked)
-            
-
-            item.setData(Qt.UserRole, layer)
-            icon = self.generate_thumbnail(layer.image)
-            item.setIcon(icon)
-            
-            self.list_widget.addItem(item)
-            actual_idx = len(self.layers)-1 - i
-            self.update_layer_item(actual_idx, item)
-        
+        self.list_model.sync()
         self._updating_ui = False
-        self.list_widget.setIconSize(QSize(40, 60))
         
         if self.layers:
             if reset:
-                self.list_widget.setCurrentRow(0) 
+                row = 0
             else:
                 # Remain the current layer index
                 index = min(self.active_layer_index, len(self.layers)-1) if index == -1 else index
-                self.list_widget.setCurrentRow(len(self.layers)-1 - index)
+                row = len(self.layers)-1 - index
+            
+            if self.list_view.currentIndex().row() != row:
+                self.list_view.setCurrentIndex(self.list_model.index(row))
+            else:
+                self.set_active_layer(row)
                 
 # ---------------------------------
 
@@ -260,12 +1353,11 @@ class LayersPanel(QWidget):
         
         # Current row in UI
         self.parent.push_undo_state()
-        row = self.list_widget.currentRow()
+        row = self.list_view.currentIndex().row()
         if row == -1: return
 
-        # Get the layer object from the item
-        item = self.list_widget.item(row)
-        layer_to_remove = item.data(Qt.UserRole)
+        # Get the layer object from the row
+        layer_to_remove = self.list_model.layer_at(row)
         
         if layer_to_remove in self.layers:
             self.layers.remove(layer_to_remove)
@@ -294,16 +1386,20 @@ class LayersPanel(QWidget):
         top_layer = self.layers[idx]
         bottom_layer = self.layers[idx - 1]
         
+        # Both premultiplied, merge without converting
+        premultiplied = top_layer.premultiplied and bottom_layer.premultiplied
         merged_img = LayerManager.merge_two_layers(
-            bottom_layer.image, 
-            top_layer.image, 
+            bottom_layer.premultiplied_image if premultiplied else bottom_layer.image, 
+            top_layer.premultiplied_image if premultiplied else top_layer.image, 
             top_layer.opacity, 
-            top_layer.blend_mode
+            top_layer.blend_mode,
+            top_layer.content_rect(),
+            premultiplied
         )
         
         # Clear current layer, and write the image down
         self.clear_layer()
-        bottom_layer.set_image(merged_img)
+        bottom_layer.set_image(merged_img, premultiplied=premultiplied)
         
         self.refresh_list()
      
@@ -320,15 +1416,19 @@ class LayersPanel(QWidget):
         top_layer = self.layers[idx]
         bottom_layer = self.layers[idx - 1]
         
+        # Both premultiplied, merge without converting
+        premultiplied = top_layer.premultiplied and bottom_layer.premultiplied
         merged_img = LayerManager.merge_two_layers(
-            bottom_layer.image, 
-            top_layer.image, 
+            bottom_layer.premultiplied_image if premultiplied else bottom_layer.image, 
+            top_layer.premultiplied_image if premultiplied else top_layer.image, 
             top_layer.opacity, 
-            top_layer.blend_mode
+            top_layer.blend_mode,
+            top_layer.content_rect(),
+            premultiplied
         )
         
         # Write image down, and delete current layer
-        bottom_layer.set_image(merged_img)
+        bottom_layer.set_image(merged_img, premultiplied=premultiplied)
         self.layers.pop(idx)
         self.active_layer_index = idx - 1
         
@@ -371,19 +1471,18 @@ class LayersPanel(QWidget):
 
     def layer_move(self, mode):
         """ Layer moving """
-        self.parent.push_undo_state()
-        
         idx = self.active_layer_index
         current_layer = self.layers.pop(idx)
         
         # mode = 1 go front, mode = -1 to down
         self.layers.insert(idx + mode, current_layer)
+        self.parent.push_undo_change(
+            LayerChange(idx, order=(idx, self.layers.index(current_layer)))
+        )
         self.refresh_list(index=idx + mode)
 
     def layer_move_top(self, mode):
         """ Layer moving to first or last """
-        self.parent.push_undo_state()
-        
         idx = self.active_layer_index
         current_layer = self.layers.pop(idx)
         
@@ -395,6 +1494,10 @@ class LayersPanel(QWidget):
         elif mode == -1:
             self.layers.insert(0, current_layer)
             self.refresh_list(index=0)
+        
+        self.parent.push_undo_change(
+            LayerChange(idx, order=(idx, self.layers.index(current_layer)))
+        )
             
 
 # ---------------------------------
@@ -406,8 +1509,8 @@ class LayersPanel(QWidget):
         if ui_row_index == -1 or self._updating_ui or \
             self.parent.dialog_open: return
         
-        item = self.list_widget.item(ui_row_index)
-        layer = item.data(Qt.UserRole)
+        layer = self.list_model.layer_at(ui_row_index)
+        if layer not in self.layers: return
         
         # Find index in backend list
         self.active_layer_index = self.layers.index(layer)
@@ -433,11 +1536,14 @@ class LayersPanel(QWidget):
     def change_opacity(self):
         """ Set image alpha """
         if self.active_layer_index != -1 and 0 <= self.active_layer_index < len(self.layers):
-            self.parent.push_undo_state()
+            idx = self.active_layer_index
+            opacity = self.opacity_slider.value() / 100.0
+            self.parent.push_undo_change(
+                LayerChange(idx, opacity=(self.layers[idx].opacity, opacity))
+            )
             self.image_changed = True
             
-            idx = self.active_layer_index
-            self.layers[idx].opacity = self.opacity_slider.value() / 100.0
+            self.layers[idx].opacity = opacity
             self.parent.display_current_image()
             
             self.update_layer_item(idx)
@@ -449,7 +1555,9 @@ class LayersPanel(QWidget):
             mode = self.combo_mode.currentText()
             
             if self.layers[idx].blend_mode != mode:
-                self.parent.push_undo_state()
+                self.parent.push_undo_change(
+                    LayerChange(idx, blend_mode=(self.layers[idx].blend_mode, mode))
+                )
                 self.layers[idx].blend_mode = mode
                 self.image_changed = True
                 
@@ -461,9 +1569,10 @@ class LayersPanel(QWidget):
         if self.active_layer_index >= len(self.layers): return
         if self.active_layer_index == 0: return 
 
-        self.parent.push_undo_state()
-        
         layer = self.layers[self.active_layer_index]
+        self.parent.push_undo_change(LayerChange(
+            self.active_layer_index, clipping_mask=(layer.clipping_mask, not layer.clipping_mask)
+        ))
         layer.clipping_mask = not layer.clipping_mask
         
         # Update UI state
@@ -474,24 +1583,21 @@ class LayersPanel(QWidget):
         self.parent.display_current_image()
     
     
-    def update_layer_item(self, index, item=None):
+    def update_layer_item(self, index):
         """"
         Update layer information
         """
-        if item is None:
-            item = self.list_widget.item(self.list_widget.currentRow())
-        layer = self.layers[index]
-        clipping_mask = "  ↳ " if layer.clipping_mask else ""
-        item.setText(f"{clipping_mask}{layer.name} \n({layer.blend_mode}) \n"\
-                    f"{int(layer.opacity*100)}%")
+        self.list_model.refresh_layer(self.layers[index])
     
 # ---------------------------------
 
-    def generate_thumbnail(self, image, size=50):
+    def generate_thumbnail(self, image, size=50, rect=None, premultiplied=False):
         """
-        Creates thumbnail by QIcon
+        Creates thumbnail QImage, safe to run in worker thread \n
+        rect: (x1, y1, x2, y2) content area, other area is transparent \n
+        premultiplied: image color is multiplied by alpha
         """
-        if image is None: return QIcon()
+        if image is None: return QImage()
         
         h, w = image.shape[:2]
         
@@ -499,9 +1605,22 @@ class LayersPanel(QWidget):
         new_w = int(w * scale)
         new_h = int(h * scale)
         
-        if new_w <= 0 or new_h <= 0: return QIcon()
+        if new_w <= 0 or new_h <= 0: return QImage()
 
-        small_img = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
+        if rect is None or image.shape[2] != 4:
+            small_img = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
+        else:
+            # Only shrink the content area
+            small_img = np.zeros((new_h, new_w, 4), dtype=np.uint8)
+            x1, y1, x2, y2 = rect
+            tx1, ty1 = int(x1 * scale), int(y1 * scale)
+            tx2, ty2 = min(new_w, int(np.ceil(x2 * scale))), min(new_h, int(np.ceil(y2 * scale)))
+            if tx1 < tx2 and ty1 < ty2:
+                content = image[int(ty1 / scale):int(np.ceil(ty2 / scale)), 
+                                int(tx1 / scale):int(np.ceil(tx2 / scale))]
+                small_img[ty1:ty2, tx1:tx2] = cv2.resize(
+                    content, (tx2 - tx1, ty2 - ty1), interpolation=cv2.INTER_NEAREST
+                )
 
         # Craete checkbox bg
         bg = np.full((new_h, new_w, 3), 204, dtype=np.uint8)
@@ -513,29 +1632,64 @@ class LayersPanel(QWidget):
 
 
         if small_img.shape[2] == 4:
-            # Split
-            b, g, r, a = cv2.split(small_img)
-            fg = cv2.merge([b, g, r])
-            
-            alpha = a.astype(float) / 255.0
-            alpha = cv2.merge([alpha, alpha, alpha])
-            
-            fg_float = fg.astype(float)
-            bg_float = bg.astype(float)
-            
-            comp = (fg_float * alpha) + (bg_float * (1.0 - alpha))
+            # Blend over the checkbox in integer
+            if premultiplied:
+                small_img = LayerManager.unpremultiply(small_img)
+            a = small_img[:, :, 3:].astype(np.uint16)
+            comp = (small_img[:, :, :3] * a + bg * (255 - a) + 127) // 255
             comp = comp.astype(np.uint8)
-            
-            comp = cv2.cvtColor(comp, cv2.COLOR_BGR2RGB)
         else:
-            comp = cv2.cvtColor(small_img, cv2.COLOR_BGR2RGB)
+            comp = small_img
 
+        return ImageBridge.to_qimage(comp)
 
-        h_c, w_c, _ = comp.shape
-        qimg = QImage(comp.data, w_c, h_c, comp.strides[0], QImage.Format_RGB888)
-        pix = QPixmap.fromImage(qimg)
+    def generate_layer_thumbnail(self, layer, size=50):
+        """
+        Icon of layer, cached per layer version \n
+        The stale icon is returned while the new one is generated in background
+        """
+        cached = self.thumbnails.get(layer)
+        if cached is not None and cached[0] == layer.version: return cached[1]
+        
+        job = self.thumbnail_jobs.get(layer)
+        if job is None or job[0] != layer.version:
+            # Small source from image pyramid, layer caches are only touched here
+            h, w = layer.shape[:2]
+            level = LayerManager.pyramid_level(size / max(h, w))
+            image = layer.level_image(level)
+            rect = LayerManager.scale_rect(layer.content_rect(), level)
+            args = (image, size, rect, layer.premultiplied)
+            
+            if not LayersPanel.background_thumbnails:
+                icon = QIcon(QPixmap.fromImage(self.generate_thumbnail(*args)))
+                self.thumbnails[layer] = (layer.version, icon)
+                return icon
+            
+            future = LayersPanel.get_thumbnail_executor().submit(self.generate_thumbnail, *args)
+            self.thumbnail_jobs[layer] = (layer.version, future)
+            future.add_done_callback(self.thumbnail_ready.emit)
         
-        return QIcon(pix)
+        return cached[1] if cached is not None else QIcon()
+
+    def collect_thumbnail(self, future):
+        """ Replace the stale icon by the finished thumbnail, jobs replaced by newer ones are dropped """
+        for layer, (version, job) in list(self.thumbnail_jobs.items()):
+            if job is not future: continue
+            
+            del self.thumbnail_jobs[layer]
+            icon = QIcon(QPixmap.fromImage(future.result()))
+            self.thumbnails[layer] = (version, icon)
+            self.list_model.refresh_layer(layer)
+            return
+
+    def get_thumbnail_executor():
+        """ Single worker thread, older requests finish first """
+        with LayersPanel.thumbnail_executor_lock:
+            if LayersPanel.thumbnail_executor is None:
+                LayersPanel.thumbnail_executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="layer_thumbnail"
+                )
+            return LayersPanel.thumbnail_executor
 
     def update_current_thumbnail(self):
         """
@@ -544,25 +1698,20 @@ class LayersPanel(QWidget):
         if self._updating_ui: return
         
         idx = self.active_layer_index
-        item = self.list_widget.item(idx)
         _, layers = self.parent.image_list[self.parent.current_index]
         if not layers: return
         
-        layer = layers[idx]
-        img = layer.image
-        
-        thumbnail = self.generate_thumbnail(img)
-        
-        item.setIcon(thumbnail)
+        # Icon is asked again by the list view
+        self.list_model.refresh_layer(layers[idx])
     
-    def rename_layer(self, item=None):
+    def rename_layer(self, index=None):
         """
         Rename 
         """
-        if item is None:
-            item = self.list_widget.item(self.list_widget.currentRow())
+        if index is None:
+            index = self.list_view.currentIndex()
 
-        layer = item.data(Qt.UserRole)
+        layer = self.list_model.layer_at(index.row())
         if not layer: return
 
         # 2. Open Input Dialog
@@ -576,24 +1725,24 @@ class LayersPanel(QWidget):
 
         # 3. Apply Change
         if ok and new_name:
-            self.parent.push_undo_state()
-            
+            self.parent.push_undo_change(
+                LayerChange(self.layers.index(layer), name=(old_name, new_name))
+            )
             layer.name = new_name
             
-            self.update_layer_item(self.active_layer_index, item)
+            self.list_model.refresh_layer(layer)
 
 
 # ---------------------------------
 
-    def on_item_changed(self, item):
+    def set_layer_visible(self, layer, is_visible):
         """Visiblity of layer"""
         if self._updating_ui or self.parent.dialog_open: return
         
-        layer = item.data(Qt.UserRole)
-        is_visible = (item.checkState() == Qt.Checked)
-        self.parent.push_undo_state()
-        
         if layer.visible != is_visible:
+            self.parent.push_undo_change(
+                LayerChange(self.layers.index(layer), visible=(layer.visible, is_visible))
+            )
             layer.visible = is_visible
             self.on_image_changed()
             self.parent.display_current_image()
@@ -610,6 +1759,11 @@ class LayersPanel(QWidget):
         """
         if not self.layers: return
         
+        # Shared composite of the document
+        index = self.parent.current_index
+        if 0 <= index < len(self.parent.image_list) and self.parent.image_list[index][1] is self.layers:
+            return self.parent.get_composite(index).copy()
+        
         if self.image_changed or self.image_buffer is None:
             self.image_buffer = LayerManager.compose_layers(self.layers)
             result_bgr = self.image_buffer.copy()
@@ -634,6 +1788,29 @@ class LayerManager:
     Handle Layer Operations \n
     Create, Merge, Blend Modes
     """
+    
+    ## Blend Engine
+    # "fixed": uint8 image with fixed-point alpha, "float": float64 image (default, reference result)
+    blend_engine = "float"
+    # {blend mode: 256x256 result table}
+    blend_lut_cache = {}
+    # (color table by [alpha, value], alpha table) of base kept by float merge
+    float_keep_lut = None
+    
+    ## Layer Storage
+    # Keep color multiplied by alpha in new layers
+    premultiplied_storage = False
+    
+    ## Tile Compositing
+    # Large area split into tiles, blended by worker threads
+    tile_size = 256
+    # Number of worker threads, 1 to composite in calling thread only
+    tile_workers = os.cpu_count() or 1
+    tile_executor = None
+    # Worker count the executor was created with
+    tile_executor_workers = 0
+    tile_executor_lock = threading.Lock()
+    
     def create_blank_layer(width, height):
         """
         Full empty transparent canvas
@@ -641,18 +1818,101 @@ class LayerManager:
         img = np.zeros((height, width, 4), dtype=np.uint8)
         return img
 
-    def merge_two_layers(base_img, overlay_img, opacity, mode="Normal"):
+    def shared_image(image, owned=False):
+        """
+        Read-only image which can be shared without copy \n
+        owned: caller gives up the image, no copy if it owns the memory
+        """
+        # Already read-only, and nobody can write its memory
+        base = image
+        while isinstance(base, np.ndarray) and not base.flags.writeable:
+            base = base.base
+        if base is None: return image
+        
+        if not owned or image.base is not None or not image.flags.writeable:
+            image = image.copy()
+        image.flags.writeable = False
+        return image
+
+    def changed_rect(old_img, new_img):
+        """
+        Bounding rect (x1, y1, x2, y2) of different pixels between two images \n
+        Return (0, 0, 0, 0) if no change
+        """
+        h, w = new_img.shape[:2]
+        if old_img is None or old_img.shape != new_img.shape:
+            return (0, 0, w, h)
+        
+        # View channels as columns, so one bounding rect for all channels
+        ch = 1 if len(new_img.shape) == 2 else new_img.shape[2]
+        diff = cv2.absdiff(old_img, new_img).reshape(h, w * ch)
+        x, y, rw, rh = cv2.boundingRect(diff)
+        if rw == 0 or rh == 0:
+            return (0, 0, 0, 0)
+        
+        return (x // ch, y, -(-(x + rw) // ch), y + rh)
+
+    def premultiply(image):
         """
-        Combine two layer with applying blend effect 
+        Straight alpha BGRA image to premultiplied alpha (color * alpha)
+        """
+        out = image.copy()
+        if image.shape[2] != 4: return out
+        
+        a = image[:, :, 3:].astype(np.uint16)
+        out[:, :, :3] = (image[:, :, :3] * a + 127) // 255
+        return out
+    
+    def unpremultiply(image):
+        """
+        Premultiplied alpha BGRA image to straight alpha (color / alpha)
+        """
+        out = image.copy()
+        if image.shape[2] != 4: return out
+        
+        # Transparent pixels have no color (0 / 1)
+        a = image[:, :, 3:].astype(np.uint32)
+        color = (image[:, :, :3] * np.uint32(255) + a // 2) // np.maximum(a, 1)
+        out[:, :, :3] = np.minimum(color, 255)
+        return out
+
+    def merge_two_layers(base_img, overlay_img, opacity, mode="Normal", rect=None, premultiplied=False):
+        """
+        Combine two layer with applying blend effect \n
+        rect: (x1, y1, x2, y2) content area of overlay, base image is kept outside \n
+        premultiplied: both images and result are premultiplied alpha
         """
         h, w = base_img.shape[:2]
         if overlay_img.shape[:2] != (h, w):
             overlay_img = cv2.resize(overlay_img, (w, h), interpolation=cv2.INTER_LANCZOS4)
+            rect = None
 
         if base_img.shape[2] == 3: 
             base_img = cv2.cvtColor(base_img, cv2.COLOR_BGR2BGRA)
         if overlay_img.shape[2] == 3: 
             overlay_img = cv2.cvtColor(overlay_img, cv2.COLOR_BGR2BGRA)
+        
+        # Only merge the content area of overlay
+        if rect is not None:
+            x1, y1, x2, y2 = rect
+            if LayerManager.blend_engine == "float" and not premultiplied:
+                # Same rounding as the float merge outside the area
+                out = LayerManager.keep_float(base_img)
+            else:
+                out = base_img.copy()
+                # Fully transparent pixels has no color after merge
+                out[:, :, :3][out[:, :, 3] == 0] = 0
+            if x1 < x2 and y1 < y2:
+                out[y1:y2, x1:x2] = LayerManager.merge_two_layers(
+                    base_img[y1:y2, x1:x2], overlay_img[y1:y2, x1:x2], opacity, mode, 
+                    premultiplied=premultiplied
+                )
+            return out
+
+        if premultiplied:
+            return LayerManager.merge_two_layers_premultiplied(base_img, overlay_img, opacity, mode)
+        if LayerManager.blend_engine == "fixed":
+            return LayerManager.merge_two_layers_fixed(base_img, overlay_img, opacity, mode)
 
         # Normaliase
         bg_float = base_img.astype(float) / 255.0
@@ -698,6 +1958,143 @@ class LayerManager:
 
         return np.clip(out * 255.0, 0, 255).astype(np.uint8)
     
+    def keep_float(base_img):
+        """
+        Base image as merged with a transparent overlay by the float engine, \n
+        color and alpha through the same float round trip, by lookup table
+        """
+        if LayerManager.float_keep_lut is None:
+            value = np.arange(256) / 255.0
+            a, v = np.meshgrid(value, value, indexing="ij")
+            
+            # Same steps as merge_two_layers with top alpha 0
+            out_rgb_pre = 0.0 + (v * a) * (1.0 - 0.0)
+            safe_a = a.copy()
+            mask_zero = (safe_a == 0)
+            safe_a[mask_zero] = 1.0
+            out_rgb = out_rgb_pre / safe_a
+            out_rgb[mask_zero] = 0
+            
+            out_a = 0.0 + value * (1.0 - 0.0)
+            LayerManager.float_keep_lut = (
+                np.clip(out_rgb * 255.0, 0, 255).astype(np.uint8),
+                np.clip(out_a * 255.0, 0, 255).astype(np.uint8),
+            )
+        
+        color_lut, alpha_lut = LayerManager.float_keep_lut
+        alpha = base_img[:, :, 3]
+        out = np.empty(base_img.shape, dtype=np.uint8)
+        out[:, :, :3] = color_lut[alpha[:, :, None], base_img[:, :, :3]]
+        out[:, :, 3] = alpha_lut[alpha]
+        return out
+    
+    def merge_two_layers_fixed(base_img, overlay_img, opacity, mode="Normal"):
+        """
+        Combine two layer by fixed-point math (same size BGRA images)
+        """
+        bg_rgb = base_img[:, :, :3]
+        bg_a = base_img[:, :, 3].astype(np.int64)
+        
+        # Alpha in 16 bits fixed-point (0 - 65535)
+        fg_rgb = overlay_img[:, :, :3]
+        fg_a = (overlay_img[:, :, 3].astype(np.int64) * round(opacity * 65535) + 127) // 255
+        
+        # Apply blend effect
+        blended_rgb = LayerManager.blend_pixel_lut(bg_rgb, fg_rgb, mode)
+        
+        # Porter-Duff 'Over' Composite Math, in (255 * 65535) unit
+        # OutAlpha = TopAlpha + BottomAlpha * (1 - TopAlpha)
+        fg_weight = fg_a * 255
+        out_a = fg_weight + bg_a * (65535 - fg_a)
+        
+        # Weight of top color in result color (Un-multiply alpha)
+        weight = np.zeros_like(out_a)
+        np.floor_divide(fg_weight * 65535, out_a, out=weight, where=out_a > 0)
+        
+        out = np.empty(base_img.shape, dtype=np.uint8)
+        out[:, :, :3] = LayerManager.lerp_fixed(bg_rgb, blended_rgb, weight.astype(np.int32))
+        out[:, :, :3][out_a == 0] = 0
+        out[:, :, 3] = out_a // 65535
+        
+        return out
+    
+    def merge_two_layers_premultiplied(base_img, overlay_img, opacity, mode="Normal"):
+        """
+        Combine two premultiplied alpha layer (same size BGRA images) \n
+        Fixed-point math, no need to divide by alpha
+        """
+        # Top alpha with opacity, 16 bits fixed-point (0 - 65535)
+        fg_a = (overlay_img[:, :, 3].astype(np.int32) * round(opacity * 65535) + 127) // 255
+        
+        if mode == "Normal":
+            fg_rgb = (overlay_img[:, :, :3].astype(np.int32) * round(opacity * 65535) + 32767) // 65535
+        else:
+            # Blend effect works on the real color
+            bg_rgb = LayerManager.unpremultiply(base_img)[:, :, :3]
+            blended_rgb = LayerManager.blend_pixel_lut(
+                bg_rgb, LayerManager.unpremultiply(overlay_img)[:, :, :3], mode
+            )
+            fg_rgb = (blended_rgb.astype(np.int32) * fg_a[:, :, None] + 32767) // 65535
+        
+        # Porter-Duff 'Over' Composite Math
+        # Out = Top + Bottom * (1 - TopAlpha), same for color and alpha
+        inv_a = 65535 - fg_a
+        out = np.empty(base_img.shape, dtype=np.uint8)
+        out[:, :, :3] = np.minimum(fg_rgb + (base_img[:, :, :3] * inv_a[:, :, None] + 32767) // 65535, 255)
+        out[:, :, 3] = np.minimum((fg_a * 255 + 32767) // 65535 + (base_img[:, :, 3] * inv_a + 32767) // 65535, 255)
+        
+        return out
+    
+    def lerp_fixed(bg, fg, alpha):
+        """
+        bg + (fg - bg) * alpha, alpha in 16 bits fixed-point (0 - 65535)
+        """
+        diff = fg.astype(np.int32) - bg
+        diff *= alpha[:, :, None]
+        diff //= 65535
+        diff += bg
+        return diff.astype(np.uint8)
+    
+    def get_blend_lut(mode):
+        """
+        Blend result table of all (bg, fg) pairs, index by bg * 256 + fg
+        """
+        lut = LayerManager.blend_lut_cache.get(mode)
+        if lut is None:
+            value = np.arange(256) / 255.0
+            bg, fg = np.meshgrid(value, value, indexing="ij")
+            
+            result = LayerManager.blend_pixel_math(bg, fg, mode)
+            lut = np.round(np.clip(result * 255.0, 0, 255)).astype(np.uint8).ravel()
+            LayerManager.blend_lut_cache[mode] = lut
+        return lut
+    
+    def blend_pixel_lut(bg, fg, mode):
+        """
+        Blend mode effect calculation by uint8 image
+        """
+        if mode == "Normal":
+            return fg
+        
+        elif mode == "Darken":
+            return np.minimum(bg, fg)
+        
+        elif mode == "Lighten":
+            return np.maximum(bg, fg)
+        
+        elif mode == "Difference":
+            return np.maximum(bg, fg) - np.minimum(bg, fg)
+        
+        elif mode == "Addition":
+            return bg + np.minimum(fg, 255 - bg)
+        
+        elif mode in ("Multiply", "Screen", "Overlay", "Soft Light"):
+            index = bg.astype(np.uint16) << 8
+            index |= fg
+            return LayerManager.get_blend_lut(mode)[index]
+
+        return fg
+    
     def blend_pixel_math(bg, fg, mode):
         """
         Blend mode effect calculation
@@ -737,34 +2134,121 @@ class LayerManager:
 
         return fg
 
-    def compose_layers(layers):
+    def alpha_bounds(image, rect):
+        """
+        Bounding box of non-transparent pixels inside rect (x1, y1, x2, y2) \n
+        (0, 0, 0, 0) if nothing found
         """
-        Composite result of all layers
+        x1, y1, x2, y2 = rect
+        if x1 >= x2 or y1 >= y2: return (0, 0, 0, 0)
+        if image.shape[2] < 4: return rect
+        
+        x, y, w, h = cv2.boundingRect(image[y1:y2, x1:x2, 3])
+        if w == 0 or h == 0: return (0, 0, 0, 0)
+        return (x1 + x, y1 + y, x1 + x + w, y1 + y + h)
+    
+    def downsample(image):
+        """
+        Half size image by average of 2x2 pixels, odd edge is repeated
+        """
+        h, w = image.shape[:2]
+        if h % 2 or w % 2:
+            image = cv2.copyMakeBorder(image, 0, h % 2, 0, w % 2, cv2.BORDER_REPLICATE)
+        return cv2.resize(image, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+    
+    def scale_rect(rect, level):
+        """
+        Rect (x1, y1, x2, y2) on the image downsampled by 2 ** level, \n
+        covering all pixels of the original rect
         """
+        x1, y1, x2, y2 = rect
+        if level <= 0: return rect
+        if x1 >= x2 or y1 >= y2: return (0, 0, 0, 0)
         
-        base_height, base_width = layers[0].image.shape[:2]
+        size = 1 << level
+        return (x1 >> level, y1 >> level, -(-x2 // size), -(-y2 // size))
+    
+    def pyramid_level(scale):
+        """
+        Pyramid level for display scale, \n
+        the image of level is not smaller than display
+        """
+        if scale <= 0 or scale > 0.5: return 0
+        return int(np.floor(np.log2(1.0 / scale)))
+    
+    def intersect_rect(rect_a, rect_b):
+        """ Overlap area of two rects, (0, 0, 0, 0) if not overlapped """
+        x1, y1 = max(rect_a[0], rect_b[0]), max(rect_a[1], rect_b[1])
+        x2, y2 = min(rect_a[2], rect_b[2]), min(rect_a[3], rect_b[3])
+        if x1 >= x2 or y1 >= y2: return (0, 0, 0, 0)
+        return (x1, y1, x2, y2)
+    
+    def contains_rect(rect_a, rect_b):
+        """ rect_b (x1, y1, x2, y2) is completely inside rect_a """
+        return rect_a[0] <= rect_b[0] and rect_a[1] <= rect_b[1] and \
+            rect_b[2] <= rect_a[2] and rect_b[3] <= rect_a[3]
+    
+    def union_rect(rect_a, rect_b):
+        """ Bounding area of two rects, empty rect is ignored """
+        if rect_a[0] >= rect_a[2] or rect_a[1] >= rect_a[3]: return rect_b
+        if rect_b[0] >= rect_b[2] or rect_b[1] >= rect_b[3]: return rect_a
+        return (
+            min(rect_a[0], rect_b[0]), min(rect_a[1], rect_b[1]),
+            max(rect_a[2], rect_b[2]), max(rect_a[3], rect_b[3])
+        )
+    
+    def compose_layers(layers, rect=None, start=0, stop=None, base=None, grid_size=20):
+        """
+        Composite result of all layers \n
+        rect: (x1, y1, x2, y2) only composite the given area of canvas \n
+        start, stop: only blend layers[start:stop] \n
+        base: composite result under layers[start], checkerboard if None \n
+        grid_size: checkerboard cell size
+        """
+        
+        base_height, base_width = layers[0].shape[:2]
+        if rect is None:
+            x1, y1, x2, y2 = 0, 0, base_width, base_height
+        else:
+            x1, y1, x2, y2 = rect
+        height, width = y2 - y1, x2 - x1
+        
+        # Large area, blend tiles in parallel
+        if LayerManager.tile_workers > 1 and height * width > 2 * LayerManager.tile_size ** 2:
+            return LayerManager.compose_layers_tiled(layers, (x1, y1, x2, y2), start, stop, base, grid_size)
     
-        grid_size = 20       
         light_color = 255   
         dark_color = 204   
 
-        y_indices = np.arange(base_height)[:, None]
-        x_indices = np.arange(base_width)[None, :]
-        checker_mask = ((y_indices // grid_size) + (x_indices // grid_size)) % 2 == 0
-
         # Initialize composite with dark color, then fill light spots
-        composite = np.full((base_height, base_width, 3), dark_color, dtype=np.uint8)
-        composite[checker_mask] = (light_color, light_color, light_color)
+        if base is None:
+            # Checkerboard follow the canvas position, not the area position
+            y_indices = np.arange(y1, y2)[:, None]
+            x_indices = np.arange(x1, x2)[None, :]
+            checker_mask = ((y_indices // grid_size) + (x_indices // grid_size)) % 2 == 0
+            
+            composite = np.full((height, width, 3), dark_color, dtype=np.uint8)
+            composite[checker_mask] = (light_color, light_color, light_color)
+        else:
+            composite = base[y1:y2, x1:x2].copy()
         
-        for i, layer in enumerate(layers):
+        stop = len(layers) if stop is None else stop
+        for i in range(start, stop):
+            layer = layers[i]
             if not layer.visible: continue
             if layer.opacity == 0: continue
-            overlay = layer.image
+            # Stored image, color multiplied by alpha if layer.premultiplied
+            overlay = layer._image
             opacity = layer.opacity
             mode = layer.blend_mode
             
-            b, g, r, a = cv2.split(overlay)
-            bgr_img = cv2.merge([b, g, r])
+            # Resize layer if it doesn't match canvas
+            area = (x1, y1, x2, y2)
+            if overlay.shape[:2] != (base_height, base_width):
+                overlay = cv2.resize(overlay, (base_width, base_height))
+            else:
+                # Only blend the area with content
+                area = LayerManager.intersect_rect(area, layer.content_rect())
             
             
         ## Clipping mask
@@ -780,10 +2264,33 @@ class LayerManager:
                 if not base_layer.visible: continue
                 if base_layer.opacity == 0: continue
                 
+                # Nothing shown outside content of base layer
+                if base_layer.shape[:2] == (base_height, base_width):
+                    area = LayerManager.intersect_rect(area, base_layer.content_rect())
+            
+            ax1, ay1, ax2, ay2 = area
+            if ax1 >= ax2 or ay1 >= ay2: continue
+            
+            overlay = overlay[ay1:ay2, ax1:ax2]
+            
+            # Premultiplied color is added directly, other cases need the real color
+            premultiplied_add = layer.premultiplied and mode == "Normal" and not layer.clipping_mask
+            if layer.premultiplied and not premultiplied_add:
+                overlay = LayerManager.unpremultiply(overlay)
+            
+            bgr_img = overlay[:, :, :3]
+            a = overlay[:, :, 3]
+            
+            if layer.clipping_mask:
                 # Apply the base layer by base layer
-                base_a = base_layer.image[:, :, 3]
-                factor = base_a.astype(float) / 255.0
-                a = (a.astype(float) * factor * base_layer.opacity).astype(np.uint8)
+                base_a = base_layer._image[ay1:ay2, ax1:ax2, 3]
+                if LayerManager.blend_engine == "fixed":
+                    # Truncated like the float engine, at most 255 * 255 * 65535, fits in uint32
+                    a = (a.astype(np.uint32) * base_a * round(base_layer.opacity * 65535)
+                         // (255 * 65535)).astype(np.uint8)
+                else:
+                    factor = base_a.astype(float) / 255.0
+                    a = (a.astype(float) * factor * base_layer.opacity).astype(np.uint8)
                 
             
             
@@ -791,14 +2298,26 @@ class LayerManager:
             ## Check if is empty canvas
             if np.max(a) == 0: 
                 continue
-            # Resize layer if it doesn't match canvas
-            if overlay.shape[:2] != composite.shape[:2]:
-                overlay = cv2.resize(overlay, (base_width, base_height))
+            
+            # Part of composite under the blending area
+            region = (slice(ay1 - y1, ay2 - y1), slice(ax1 - x1, ax2 - x1))
+            bg_img = composite[region]
+            
+            if premultiplied_add:
+                composite[region] = LayerManager.over_premultiplied(bg_img, bgr_img, a, opacity)
+                continue
 
+            if LayerManager.blend_engine == "fixed":
+                blended_img = LayerManager.blend_pixel_lut(bg_img, bgr_img, mode)
+                
+                # Apply Opacity to Alpha Channel, 16 bits fixed-point
+                alpha = (a.astype(np.int32) * round(opacity * 65535) + 127) // 255
+                composite[region] = LayerManager.lerp_fixed(bg_img, blended_img, alpha)
+                continue
             
             # Applying layer blending mode
             fg_float = bgr_img.astype(float) / 255.0
-            bg_float = composite.astype(float) / 255.0
+            bg_float = bg_img.astype(float) / 255.0
             blended_img = LayerManager.blend_pixel_math(bg_float, fg_float, mode)
             
             
@@ -809,8 +2328,78 @@ class LayerManager:
             
             # Perform blending
             output = (blended_img * alpha_mask) + (bg_float * (1.0 - alpha_mask))
-            composite = np.clip(output * 255.0, 0, 255).astype(np.uint8)
+            composite[region] = np.clip(output * 255.0, 0, 255).astype(np.uint8)
             
         return composite
-
-
+    
+    def compose_layers_tiled(layers, rect, start=0, stop=None, base=None, grid_size=20):
+        """
+        Same result as compose_layers, the area split into tiles \n
+        and blended by the worker threads
+        """
+        x1, y1, x2, y2 = rect
+        tile = LayerManager.tile_size
+        
+        # Resize mismatched layers once, not in every tile
+        base_height, base_width = layers[0].shape[:2]
+        tile_layers = []
+        for layer in layers:
+            if layer.shape[:2] != (base_height, base_width):
+                layer = copy.copy(layer)
+                layer._image = cv2.resize(layer._image, (base_width, base_height))
+                layer.content_cache = None
+                layer.straight_cache = None
+            
+            # Find content once, not in every tile
+            layer.content_rect()
+            tile_layers.append(layer)
+        
+        composite = np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint8)
+        
+        def compose_tile(tile_rect):
+            tx1, ty1, tx2, ty2 = tile_rect
+            composite[ty1 - y1:ty2 - y1, tx1 - x1:tx2 - x1] = LayerManager.compose_layers(
+                tile_layers, tile_rect, start, stop, base, grid_size
+            )
+        
+        # Tiles follow the canvas grid, so same tiles for every area
+        tiles = [
+            (max(tx, x1), max(ty, y1), min(tx + tile, x2), min(ty + tile, y2))
+            for ty in range(y1 - y1 % tile, y2, tile)
+            for tx in range(x1 - x1 % tile, x2, tile)
+        ]
+        
+        # list() to raise the error of workers
+        list(LayerManager.get_tile_executor().map(compose_tile, tiles))
+        return composite
+    
+    def over_premultiplied(bg, fg, a, opacity):
+        """
+        Premultiplied color fg over opaque bg \n
+        bg * (1 - alpha) + fg, single multiply-add per pixel
+        """
+        if LayerManager.blend_engine == "fixed":
+            # 16 bits fixed-point
+            op = round(opacity * 65535)
+            inv_a = 65535 - (a.astype(np.int32) * op + 127) // 255
+            out = (fg.astype(np.int32) * op + 32767) // 65535
+            out += (bg * inv_a[:, :, None] + 32767) // 65535
+            return np.minimum(out, 255).astype(np.uint8)
+        
+        inv_a = 1.0 - (a / 255.0) * opacity
+        out = fg * opacity + bg * inv_a[:, :, None]
+        return np.clip(out, 0, 255).astype(np.uint8)
+    
+    def get_tile_executor():
+        """ Shared worker threads of tile compositing """
+        with LayerManager.tile_executor_lock:
+            executor = LayerManager.tile_executor
+            if executor is None or LayerManager.tile_executor_workers != LayerManager.tile_workers:
+                if executor is not None:
+                    executor.shutdown(wait=False)
+                executor = ThreadPoolExecutor(
+                    max_workers=LayerManager.tile_workers, thread_name_prefix="compose_tile"
+                )
+                LayerManager.tile_executor = executor
+                LayerManager.tile_executor_workers = LayerManager.tile_workers
+            return executor
@@ -6,11 +6,12 @@ from PyQt5.QtWidgets import (
     QDialog, QCheckBox, QLabel, QSlider, QPushButton, QColorDialog
 )
 from PyQt5.QtGui import (
-    QImage, QPixmap, QCloseEvent, QPainter, QPen, QColor, QPainterPath
+    QPixmap, QCloseEvent, QPainter, QPen, QColor, QPainterPath
 )
-from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtCore import Qt, QRect, QTimer
 
 from Assignment_2.LayerManager import LayerManager
+from Assignment_2.ImageBridge import ImageBridge
 from Assignment_1.SelectLabel import SelectLabel
 
 
@@ -55,6 +56,13 @@ class ImageViewWindow(QMainWindow):
         self.display_scale_x = 1.0
         self.display_scale_y = 1.0
         self.display_offset = 0.0, 0.0
+        # (image, level, pixmap) rescaled on resize
+        self.source_pixmap = None
+        
+        # Fast pass while resizing, smooth pass once settled
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.timeout.connect(self.update_scaled_image)
         
         self.undo_stack = self.parent.undo_stack
         
@@ -94,37 +102,42 @@ class ImageViewWindow(QMainWindow):
             self.image_label.clear()
             return
 
-        self.display_image = image.copy()
+        # Composite is shared and never changed, keep it without copy
+        self.display_image = image
         self.update_scaled_image()
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
-        self.update_scaled_image()
-
-    def update_scaled_image(self):
+        self.update_scaled_image(fast=True)
+        self.settle_timer.start(self.parent.settle_delay)
+
+    def update_scaled_image(self, fast=False):
+        """
+        Scale image to fit window \n
+        fast: nearest scaling for interactive resize, followed by a smooth pass
+        """
         if self.display_image is None:
             return
 
         image = self.display_image
-        if len(image.shape) == 2: 
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
-        elif len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
-        h, w, _ = image.shape
-        
-        bytes_per_line = image.strides[0]
-        qt_image = QImage(
-            image.data, 
-            w, h, bytes_per_line, 
-            QImage.Format_RGBA8888
-        ).rgbSwapped()
-        pix = QPixmap.fromImage(qt_image)
+        h, w = image.shape[:2]
 
         label_w = self.image_label.width()
         label_h = self.image_label.height()
         
+        # Smaller composite close to window size
+        level = LayerManager.pyramid_level(min(label_w / w, label_h / h))
+        if level > 0 and 0 <= self.current_index < len(self.parent.compositor_list):
+            image = self.parent.get_composite(self.current_index, level)
+        
+        # Pixmap is reused until image or level changes
+        cache = self.source_pixmap
+        if cache is None or cache[0] is not self.display_image or cache[1] != level:
+            cache = self.source_pixmap = (self.display_image, level, ImageBridge.to_pixmap(image))
+        
         # Scale to fit window
-        scaled_pix = pix.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        mode = Qt.FastTransformation if fast else Qt.SmoothTransformation
+        scaled_pix = cache[2].scaled(self.image_label.size(), Qt.KeepAspectRatio, mode)
         self.image_label.setPixmap(scaled_pix)
 
         x_offset = (label_w - scaled_pix.width()) // 2
@@ -157,12 +170,8 @@ class ImageViewWindow(QMainWindow):
             self.parent.display_current_image(reset_scale)
             return
         # Only update self view window
-        _, layers = self.parent.image_list[self.current_index]
-        self.set_image(LayerManager.compose_layers(layers))
-        self.parent.display_thumbnail_image()
-        
-        if self.parent.histogram_panel.isVisible():
-            self.parent.histogram_panel.update_histogram()
+        self.set_image(self.parent.get_composite(self.current_index))
+        self.parent.schedule_idle(self.parent.display_thumbnail_image, self.parent.update_histograms)
 
     def update_image_display(self):
         self.parent.update_image_display()
@@ -187,8 +196,8 @@ class ImageViewWindow(QMainWindow):
                 i.on_focus = False
                 i.disabled_selection_mode()
     
-    def current_focus_layer_image(self, img=None): 
-        return self.parent.current_focus_layer_image(img)
+    def current_focus_layer_image(self, img=None, rect=None): 
+        return self.parent.current_focus_layer_image(img, rect)
     def get_current_focus_layer(self): 
         return self.parent.get_current_focus_layer()
     
@@ -1,6 +1,7 @@
 import sys
 import cv2
 import os
+import math
 import numpy as np
 import matplotlib.pyplot as plt
 from PyQt5.QtWidgets import (
@@ -14,7 +15,7 @@ from PyQt5.QtGui import (
     QImage, QPixmap, QPainter, QPen, QColor, QIcon, QFont, 
 )
 from PyQt5.QtCore import (
-    Qt, QRect
+    Qt, QRect, QRectF, QSize, QTimer, QElapsedTimer
 )
 
 
@@ -44,8 +45,10 @@ from Assignment_2.FilterOperation import (
     BitPlaneSlicer, EdgeDetectionPanel, ThresholdPanel, 
 )
 from Assignment_2.LayerManager import (
-    Layer, LayerManager, LayersPanel, LayerState
+    Layer, LayerCommand, LayerHistory, LayerManager, LayersPanel, LayerTransform
 )
+from Assignment_2.LayerCompositor import LayerCompositor
+from Assignment_2.ImageBridge import ImageBridge
 from Assignment_2.Tools import (
     PenPreviewWidget, GridSettingsDialog, ImageViewWindow
 )
@@ -107,6 +110,15 @@ class myWindowsOpencV(QMainWindow):
     """
     Main Window for Paint Application
     """
+    
+    ## Repaint scheduling
+    # Minimum time between two display refreshes (ms)
+    frame_interval = 16
+    # Quiet time before histograms and thumbnails are refreshed (ms)
+    idle_delay = 150
+    # Quiet time after zoom or resize before the smooth pass (ms)
+    settle_delay = 120
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Assignment Paint Application: BS23110051")
@@ -138,10 +150,35 @@ class myWindowsOpencV(QMainWindow):
         self.zoom_factor = 1.0
         self.move_diff_pos = None
         self.canva_offset = (0, 0)
+        # (image, (index, version, level, scaled size, fast), scaled area, pixmap) drawn on canvas
+        self.scaled_cache = None
         self.release_cancel_move_mode = False
+        
+        # One coalesced display refresh per frame, reset_scale is None if none is pending
+        self.refresh_reset = None
+        # Layers changed, composite again on next refresh
+        self.display_dirty = False
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.refresh_display)
+        self.frame_clock = QElapsedTimer()
+        self.frame_clock.start()
+        
+        # Expensive consumers run once the display is quiet
+        self.idle_jobs = set()
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(self.run_idle_jobs)
+        
+        # Nearest scaling of visible area while zooming, smooth pass once settled
+        self.fast_render = False
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.timeout.connect(self.settle_display)
 
         self.undo_stack = []
         self.redo_stack = []
+        self.compositor_list = []
         
         self.selected_rect = (0, 0, 0, 0)
         
@@ -1136,8 +1173,9 @@ class myWindowsOpencV(QMainWindow):
             self.image_list.append((path, [base_layer]))
             self.original_image_list.append(img)
             
-            self.undo_stack.append([])
-            self.redo_stack.append([])
+            self.undo_stack.append(LayerHistory())
+            self.redo_stack.append(LayerHistory())
+            self.compositor_list.append(LayerCompositor())
                 
         self.current_index = len(self.image_list)-1
         self.create_canvas_buttons()
@@ -1158,8 +1196,9 @@ class myWindowsOpencV(QMainWindow):
                 self.original_image_list.append(img)
                 self.add_recently_used(file_path)
                 
-                self.undo_stack.append([])
-                self.redo_stack.append([])
+                self.undo_stack.append(LayerHistory())
+                self.redo_stack.append(LayerHistory())
+                self.compositor_list.append(LayerCompositor())
                 
             self.current_index = len(self.image_list)-1
             self.main_index = self.current_index
@@ -1185,21 +1224,7 @@ class myWindowsOpencV(QMainWindow):
             return
         
         # Output image of all layers
-        image = self.display_image
-        if len(image.shape) == 2: 
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
-        elif len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
-        height, width, _ = image.shape
-
-            
-        bytes_per_line = image.strides[0]
-        qt_image = QImage(
-            image.data, 
-            width, height, bytes_per_line, 
-            QImage.Format_RGBA8888
-        ).rgbSwapped()
-        pix = QPixmap.fromImage(qt_image)
+        height, width = self.display_image.shape[:2]
 
         label_w = self.image_label.width()
         label_h = self.image_label.height()
@@ -1216,15 +1241,23 @@ class myWindowsOpencV(QMainWindow):
         # Final scale to canvas
         total_scale = self.origin_zoom * self.zoom_factor
         
-        # Scale image
+        # Zoomed out, use smaller composite close to display size
+        image = self.display_image
+        level = LayerManager.pyramid_level(total_scale)
+        if level > 0:
+            image = self.get_composite(self.main_index, level)
+        image_h, image_w = image.shape[:2]
+        
+        # Size of scaled image, only the visible part is really scaled
         new_w = int(width * total_scale)
         new_h = int(height * total_scale)
-        scaled_pix = pix.scaled(new_w, new_h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        scaled_size = QSize(image_w, image_h).scaled(new_w, new_h, Qt.KeepAspectRatio)
+        scaled_w, scaled_h = scaled_size.width(), scaled_size.height()
         
         
     ## View Moving Control
-        x_offset = (label_w - scaled_pix.width()) // 2
-        y_offset = (label_h - scaled_pix.height()) // 2
+        x_offset = (label_w - scaled_w) // 2
+        y_offset = (label_h - scaled_h) // 2
         x_canva_offset, y_canva_offset = self.canva_offset
         
         if self.move_diff_pos != None:
@@ -1232,78 +1265,164 @@ class myWindowsOpencV(QMainWindow):
             y_canva_offset    += self.move_diff_pos.y()
             self.canva_offset = x_canva_offset, y_canva_offset
         
-        self.display_scale_x    = scaled_pix.width() / width
-        self.display_scale_y    = scaled_pix.height() / height
+        self.display_scale_x    = scaled_w / width
+        self.display_scale_y    = scaled_h / height
         self.display_offset     = (x_offset + x_canva_offset, y_offset + y_canva_offset)
 
     ## Apply view control
         canvas = QPixmap(label_w, label_h)
         canvas.fill(Qt.transparent)
-
-        painter = QPainter(canvas)
-        painter.drawPixmap(x_offset + x_canva_offset, y_offset + y_canva_offset, scaled_pix)
-        painter.end()
+        
+        # Area inside label in scaled image space, cost bounded by label size
+        pos_x, pos_y = self.display_offset
+        x1, y1 = max(0, -pos_x), max(0, -pos_y)
+        x2, y2 = min(scaled_w, label_w - pos_x), min(scaled_h, label_h - pos_y)
+        
+        if x1 < x2 and y1 < y2:
+            # Panning only moves the cached pixmap until it leaves the cached area
+            key = (
+                self.main_index, self.compositor_list[self.main_index].version, 
+                level, scaled_w, scaled_h, self.fast_render
+            )
+            cache = self.scaled_cache
+            if cache is None or cache[0] is not self.display_image or cache[1] != key or \
+                    not LayerManager.contains_rect(cache[2], (x1, y1, x2, y2)):
+                
+                # Keep a margin around the visible area for next moves, not while zooming
+                margin_w, margin_h = (0, 0) if self.fast_render else (label_w // 2, label_h // 2)
+                area = (
+                    max(0, x1 - margin_w), max(0, y1 - margin_h),
+                    min(scaled_w, x2 + margin_w), min(scaled_h, y2 + margin_h)
+                )
+                pixmap = self.render_scaled_area(
+                    image, scaled_w / image_w, scaled_h / image_h, area, not self.fast_render
+                )
+                cache = self.scaled_cache = (self.display_image, key, area, pixmap)
+            
+            painter = QPainter(canvas)
+            painter.drawPixmap(pos_x + cache[2][0], pos_y + cache[2][1], cache[3])
+            painter.end()
 
         self.image_label.setPixmap(canvas)
         self.image_label.update_selected_rect()
         
         
-    # Display thumbnail image   
-        self.display_thumbnail_image()
+    # Display thumbnail image when idle
+        self.schedule_idle(self.display_thumbnail_image)
+    
+        self.update_button_menu()
+    
+    def render_scaled_area(self, image, scale_x, scale_y, area, smooth=True):
+        """
+        Pixmap of image scaled by (scale_x, scale_y), \n
+        only the area (x1, y1, x2, y2) of scaled image is converted and scaled \n
+        smooth: bilinear scaling, otherwise nearest for the fast pass
+        """
+        px1, py1, px2, py2 = area
+        image_h, image_w = image.shape[:2]
+        
+        # Area in image space
+        x1, y1 = int(px1 / scale_x), int(py1 / scale_y)
+        x2 = min(image_w, math.ceil(px2 / scale_x))
+        y2 = min(image_h, math.ceil(py2 / scale_y))
+        
+        # Crop is wrapped as is, without copy
+        qt_image = ImageBridge.to_qimage(image[y1:y2, x1:x2])
+        
+        pixmap = QPixmap(px2 - px1, py2 - py1)
+        pixmap.fill(Qt.transparent)
+        
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, smooth)
+        painter.drawImage(QRectF(
+            x1 * scale_x - px1, y1 * scale_y - py1, 
+            (x2 - x1) * scale_x, (y2 - y1) * scale_y
+        ), qt_image)
+        painter.end()
+        return pixmap
+    
+    def display_current_image(self, reset_scale=False):
+        """
+        Mark current document changed and schedule the display refresh, \n
+        repeated calls before next frame are coalesced into one composite and refresh, \n
+        use get_composite() if the result is needed right away
+        """
+        if 0 <= self.main_index < len(self.image_list):
+            self.display_dirty = True
+            self.schedule_refresh(reset_scale)
+    def schedule_refresh(self, reset_scale=False):
+        """ Refresh display at next event loop turn, no sooner than frame_interval after last one """
+        self.refresh_reset = bool(self.refresh_reset) or reset_scale
+        if self.frame_timer.isActive(): return
+        
+        wait = self.frame_interval - self.frame_clock.elapsed()
+        self.frame_timer.start(max(0, wait))
+    def refresh_display(self):
+        """ Coalesced refresh of layer list, canvas and view windows """
+        reset_scale, self.refresh_reset = bool(self.refresh_reset), None
+        self.frame_timer.stop()
+        self.frame_clock.restart()
+        if not 0 <= self.main_index < len(self.image_list): return
+        
+        file_path, layers = self.image_list[self.main_index]
+        if self.display_dirty or self.display_image is None:
+            self.display_image = self.get_composite(self.main_index)
+            self.display_dirty = False
+        self.layer_panel.refresh_list()
+        self.update_image_display(reset_scale, reset_scale)
+        self.setWindowTitle(file_path)
         
-
     # Display view windows
         for w in self.view_windows:
             if not w.isVisible(): continue
             if w.current_index == self.main_index:
-                w.set_image(image)
+                w.set_image(self.display_image)
                 continue
-            _, layers = self.image_list[w.current_index]
-            w.set_image(LayerManager.compose_layers(layers))
-    
-        self.update_button_menu()
-    
-    def display_current_image(self, reset_scale=False):
-        if 0 <= self.main_index < len(self.image_list):
-            
-            file_path, layers = self.image_list[self.main_index]
-            self.display_image = LayerManager.compose_layers(layers)
-            self.layer_panel.refresh_list()
-            
-            # Update Histogram 
-            if self.histogram_panel.isVisible():
-                self.histogram_panel.update_histogram()
-            if self.histogram_display is not None:
-                self.histogram_display.update_histogram()
-            
-            self.update_image_display(reset_scale, reset_scale)
-            self.setWindowTitle(file_path)
+            w.set_image(self.get_composite(w.current_index))
+        
+        self.schedule_idle(self.display_thumbnail_image, self.update_histograms)
+    def schedule_idle(self, *jobs):
+        """ Run jobs once after display is quiet for idle_delay, repeated jobs run only once """
+        self.idle_jobs.update(jobs)
+        self.idle_timer.start(self.idle_delay)
+    def run_idle_jobs(self):
+        jobs, self.idle_jobs = self.idle_jobs, set()
+        for job in jobs:
+            job()
+    def update_histograms(self):
+        if not 0 <= self.current_index < len(self.image_list): return
+        
+        if self.histogram_panel.isVisible():
+            self.histogram_panel.update_histogram()
+        if self.histogram_display is not None:
+            self.histogram_display.update_histogram()
+    def get_composite(self, index, level=0):
+        """
+        Composite result of document, only recompute the changed area \n
+        level: composite of layers downsampled by 2 ** level
+        """
+        _, layers = self.image_list[index]
+        return self.compositor_list[index].compose(layers, level)
     def update_image_display_preview(self, preview):
-        h, w = preview.shape[:2]
-        bytes_per_line = preview.strides[0]
-        qimg = QImage(preview.tobytes(), w, h, bytes_per_line, QImage.Format_BGR888)
-        pix = QPixmap.fromImage(qimg)
+        pix = ImageBridge.to_pixmap(preview)
         scaled_pix = pix.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.image_label.setPixmap(scaled_pix)
     
     def display_thumbnail_image(self):
         current_focus = self.get_focus_window()
-        image = current_focus.display_image.copy()
+        image = current_focus.display_image
         if image is None: return
         
-        if len(image.shape) == 2: 
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
-        elif len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
-        height, width, _ = image.shape
-            
-        bytes_per_line = image.strides[0]
-        qt_image = QImage(
-            image.data, 
-            width, height, bytes_per_line, 
-            QImage.Format_RGBA8888
-        ).rgbSwapped()
-        pix = QPixmap.fromImage(qt_image)
+        # Smaller composite close to thumbnail size
+        index = self.main_index if current_focus is self else current_focus.current_index
+        height, width = image.shape[:2]
+        level = LayerManager.pyramid_level(min(
+            self.thumbnail_label.width() / width, self.thumbnail_label.height() / height
+        ))
+        if level > 0 and 0 <= index < len(self.compositor_list):
+            image = self.get_composite(index, level)
+        
+        pix = ImageBridge.to_pixmap(image)
         
         thumb_pix = pix.scaled(
         self.thumbnail_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
@@ -1325,8 +1444,8 @@ class myWindowsOpencV(QMainWindow):
         for i in self.view_windows:
             i.on_focus = False
             i.disabled_selection_mode()
-    def current_focus_layer_image(self, img=None):
-        """ Get or set current layer image """
+    def current_focus_layer_image(self, img=None, rect=None):
+        """ Get or set current layer image, rect: changed area (x1, y1, x2, y2) """
         
         layer_idx = self.layer_panel.active_layer_index
         if layer_idx < 0 or self.current_index < 0: return None
@@ -1334,7 +1453,7 @@ class myWindowsOpencV(QMainWindow):
         
         _, layers = self.image_list[self.current_index]
         if img is not None:
-            self.layer_panel.layers[layer_idx].set_image(img)
+            self.layer_panel.layers[layer_idx].set_image(img, rect)
             return None
         return layers[layer_idx].image
     def get_current_focus_layer(self): 
@@ -1351,15 +1470,8 @@ class myWindowsOpencV(QMainWindow):
     def backup_all_layer(self):
         layers = []
         for layer in self.layer_panel.layers:
-            state = LayerState(
-                name=layer.name,
-                opacity=layer.opacity,
-                is_visible=layer.visible,
-                blend_mode=layer.blend_mode,
-                clipping_mask=layer.clipping_mask, 
-                image_data=layer.image 
-            )
-            layers.append(state)
+            # Shares the layer image, the layer keeps it unchanged for the state
+            layers.append(layer.make_state())
         return layers
     def get_all_backup_layer(self, layers_data):
         layers = []
@@ -1383,13 +1495,13 @@ class myWindowsOpencV(QMainWindow):
         
         
         orig_path, layers = self.image_list[self.current_index]
-        img = LayerManager.compose_layers(layers)
+        img = self.get_composite(self.current_index).copy()
         
         if not os.path.exists(orig_path) or orig_path.startswith("NewCanvas_"):
             self.save_image_as(empty_canvas=True)
             return
 
-        success = cv2.imwrite(orig_path, self.display_image)
+        success = cv2.imwrite(orig_path, img)
         if not success: return
         
         print(f"Image saved successfully at: {orig_path}")
@@ -1408,7 +1520,7 @@ class myWindowsOpencV(QMainWindow):
         
         default_name = "new_image.jpg"
         orig_path, layers = self.image_list[self.current_index]
-        img = LayerManager.compose_layers(layers)
+        img = self.get_composite(self.current_index).copy()
         
         base = os.path.basename(orig_path)
         name, ext = os.path.splitext(base)
@@ -1453,8 +1565,9 @@ class myWindowsOpencV(QMainWindow):
             self.current_index        = len(self.image_list) - 1
             self.main_index           = self.current_index
             
-            self.undo_stack.append([])
-            self.redo_stack.append([])
+            self.undo_stack.append(LayerHistory())
+            self.redo_stack.append(LayerHistory())
+            self.compositor_list.append(LayerCompositor())
             
             self.layer_panel.set_layers([layer])
             self.display_image = layer.image
@@ -1481,8 +1594,9 @@ class myWindowsOpencV(QMainWindow):
         self.current_index = len(self.image_list) - 1
         self.main_index = self.current_index
         
-        self.undo_stack.append([])
-        self.redo_stack.append([])
+        self.undo_stack.append(LayerHistory())
+        self.redo_stack.append(LayerHistory())
+        self.compositor_list.append(LayerCompositor())
         
         self.layer_panel.set_layers([layer])
         self.display_image = layer.image
@@ -1509,8 +1623,9 @@ class myWindowsOpencV(QMainWindow):
         self.image_list.pop(closed_index)
         self.original_image_list.pop(closed_index)
         
-        self.undo_stack.pop(closed_index)
-        self.redo_stack.pop(closed_index)
+        self.undo_stack.pop(closed_index).clear()
+        self.redo_stack.pop(closed_index).clear()
+        self.compositor_list.pop(closed_index)
         
         ## Close related view windows
         delete_list = []
@@ -1567,8 +1682,9 @@ class myWindowsOpencV(QMainWindow):
         self.current_index = len(self.image_list) - 1
         self.main_index = self.current_index
         
-        self.undo_stack.append([])
-        self.redo_stack.append([])
+        self.undo_stack.append(LayerHistory())
+        self.redo_stack.append(LayerHistory())
+        self.compositor_list.append(LayerCompositor())
         
         self.layer_panel.set_layers([layer])
         self.display_image = layer.image
@@ -1720,18 +1836,12 @@ class myWindowsOpencV(QMainWindow):
         if self.display_image is None:
             return
 
-        self.push_undo_state()
-        _, layers = self.image_list[self.current_index]
-        
-        for layer in layers:
-            img = layer.image
+        # Undo by flipping again, no pixels are stored
+        transform = LayerTransform("flip_h" if mode == "h" else "flip_v")
+        self.push_undo_change(transform)
         
-            if mode == "h":
-                flip_img = cv2.flip(img, 1)  # horizontal flip
-            elif mode == "v":
-                flip_img = cv2.flip(img, 0)  # vertical flip
-        
-            layer.set_image(flip_img)
+        _, layers = self.image_list[self.current_index]
+        transform.apply(layers)
         
         self.display_current_image()
 #/layer
@@ -1762,19 +1872,12 @@ class myWindowsOpencV(QMainWindow):
     def rotate_image_90_degree(self, type=1):
         if self.display_image is None: return
 
-        self.push_undo_state()
+        # Undo by rotating back, no pixels are stored
+        transform = LayerTransform(LayerTransform.rotations[type])
+        self.push_undo_change(transform)
         
         _, layers = self.image_list[self.current_index]
-        for layer in layers:
-            img = layer.image
-            if type == 1:
-                rotated = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-            elif type == -1:
-                rotated = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
-            elif type == 180:
-                rotated = cv2.rotate(img, cv2.ROTATE_180)
-            layer.set_image(rotated)
-
+        transform.apply(layers)
         
         self.display_current_image()
 #/layer
@@ -1912,27 +2015,7 @@ class myWindowsOpencV(QMainWindow):
         """
         Apply the result, if there are ROI existing
         """
-        if roi != (0, 0, 0, 0):
-            if len(img.shape) == 2:
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
-            elif len(img.shape) == 3:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-                
-            if len(result.shape) == 2:
-                result = cv2.cvtColor(result, cv2.COLOR_GRAY2BGRA)
-            elif len(result.shape) == 3:
-                result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
-            
-            x1, y1, x2, y2 = roi
-            h, w = result.shape[:2]
-            x1, x2 = max(0, min(x1, w)), max(0, min(x2, w))
-            y1, y2 = max(0, min(y1, h)), max(0, min(y2, h))
-            
-            region = img.copy()
-            region[y1:y2, x1:x2] = result[y1:y2, x1:x2]
-        else:
-            region = result
-        return region
+        return LayerCommand.apply_rect(img, result, roi)
     
     
     def copy(self):
@@ -2118,7 +2201,7 @@ class myWindowsOpencV(QMainWindow):
         image_name = self.image_list[self.current_index][0]
         view = ImageViewWindow(self, self.current_index, image_name, self.image_list)
         view.show()
-        view.set_image(self.display_image)
+        view.set_image(self.get_composite(self.current_index))
 
         self.view_windows.append(view)
 
@@ -2354,9 +2437,23 @@ class myWindowsOpencV(QMainWindow):
     def layer_rotate(self, type=1):
         if self.display_image is None: return
 
+        layer = self.get_current_focus_layer()
+        
+        # Resized back to layer size, only invertible if the size is unchanged
+        h, w = layer.shape[:2]
+        if type == 180 or h == w:
+            _, layers = self.image_list[self.current_index]
+            transform = LayerTransform(
+                LayerTransform.rotations[type], self.layer_panel.active_layer_index
+            )
+            self.push_undo_change(transform)
+            transform.apply(layers)
+            
+            self.display_current_image()
+            return
+        
         self.push_undo_state()
         
-        layer = self.get_current_focus_layer()
         img = layer.image.copy()
         if type == 1:
             rotated = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
@@ -2373,16 +2470,16 @@ class myWindowsOpencV(QMainWindow):
     def layer_flip(self, mode):
         if self.display_image is None: return
 
-        self.push_undo_state()
-        layer = self.get_current_focus_layer()
-        img = layer.image.copy()
-    
-        if mode == "h":
-            flip_img = cv2.flip(img, 1)  # horizontal flip
-        elif mode == "v":
-            flip_img = cv2.flip(img, 0)  # vertical flip
-    
-        layer.set_image(flip_img)
+        if self.get_current_focus_layer() is None: return
+        _, layers = self.image_list[self.current_index]
+        
+        # Undo by flipping again, no pixels are stored
+        transform = LayerTransform(
+            "flip_h" if mode == "h" else "flip_v", self.layer_panel.active_layer_index
+        )
+        self.push_undo_change(transform)
+        transform.apply(layers)
+        
         self.display_current_image()
     
     def layer_move(self, mode):
@@ -2486,7 +2583,15 @@ class myWindowsOpencV(QMainWindow):
         self.zoom_label.setText(f"Zoom: {_value:.1f} %")
         
         if change: 
-            self.update_image_display()
+            self.interactive_display()
+    def interactive_display(self):
+        """ Fast display while user keeps zooming, one smooth pass after settle_delay """
+        self.fast_render = True
+        self.settle_timer.start(self.settle_delay)
+        self.update_image_display()
+    def settle_display(self):
+        self.fast_render = False
+        self.update_image_display()
     def zoom_slider_changed(self, value):
         percent = 0.0
         
@@ -2501,7 +2606,7 @@ class myWindowsOpencV(QMainWindow):
 
         self.zoom_factor = percent / 100.0
         self.zoom_label.setText(f"Zoom: {percent:.1f} %")
-        self.update_image_display()
+        self.interactive_display()
     
     def push_undo_state(self, reset_redo=True):
         if self.display_image is None or self.current_index < 0:
@@ -2510,19 +2615,76 @@ class myWindowsOpencV(QMainWindow):
         layers = self.backup_all_layer()
         
         self.undo_stack[self.current_index].append(layers)
-        if reset_redo: self.redo_stack[self.current_index] = []
+        if reset_redo: self.redo_stack[self.current_index].clear()
         
         
         if len(self.undo_stack[self.current_index]) > self.max_undo:
             self.undo_stack[self.current_index].pop(0)
         
         self.update_button_menu()     
+    def push_undo_change(self, change, reset_redo=True):
+        """ Record a LayerChange of layer properties, no pixels are stored """
+        if self.display_image is None or self.current_index < 0:
+            return
+        
+        self.undo_stack[self.current_index].append(change)
+        if reset_redo: self.redo_stack[self.current_index].clear()
+        
+        if len(self.undo_stack[self.current_index]) > self.max_undo:
+            self.undo_stack[self.current_index].pop(0)
+        
+        self.update_button_menu()
+    def push_undo_command(self, command):
+        """ Log a LayerCommand on the state saved before it was applied """
+        if self.display_image is None or self.current_index < 0:
+            return
+        
+        self.undo_stack[self.current_index].attach_command(command)
+        self.redo_stack[self.current_index].clear()
+        self.update_button_menu()
+    def apply_layer_change(self, change, redo):
+        """ Apply or revert the property change on current layers """
+        layers = self.layer_panel.layers
+        index = change.apply(layers) if redo else change.revert(layers)
+        
+        self.layer_panel.on_image_changed()
+        self.layer_panel.refresh_list(index=index)
+        self.display_current_image()
+        self.update_button_menu()
     def undo(self):
         if self.image_label.transform_mode: return
         if len(self.undo_stack) <= self.current_index or self.current_index < 0: return
         if not self.undo_stack[self.current_index]:
             return
 
+        change = self.undo_stack[self.current_index].newest_change()
+        if isinstance(change, LayerCommand):
+            # Replay the logged commands from the keyframe
+            layers_data, changes = self.undo_stack[self.current_index].replay_base()
+            self.undo_stack[self.current_index].pop()
+            self.redo_stack[self.current_index].append(change)
+            if len(self.redo_stack[self.current_index]) > self.max_redo:
+                self.redo_stack[self.current_index].pop(0)
+            
+            layers = self.get_all_backup_layer(layers_data)
+            for c in changes: c.apply(layers)
+            
+            path, _ = self.image_list[self.current_index]
+            self.image_list[self.current_index] = (path, layers)
+            self.layer_panel.set_layers(layers)
+            self.display_current_image()
+            self.update_button_menu()
+            return
+        
+        if change is not None:
+            self.undo_stack[self.current_index].pop()
+            self.redo_stack[self.current_index].append(change)
+            if len(self.redo_stack[self.current_index]) > self.max_redo:
+                self.redo_stack[self.current_index].pop(0)
+            
+            self.apply_layer_change(change, redo=False)
+            return
+
         self.push_redo_state()
         layers_data = self.undo_stack[self.current_index].pop().copy()
         layers = self.get_all_backup_layer(layers_data)
@@ -2552,6 +2714,22 @@ class myWindowsOpencV(QMainWindow):
         if not self.redo_stack[self.current_index]:
             return
         
+        change = self.redo_stack[self.current_index].newest_change()
+        if isinstance(change, LayerCommand):
+            self.redo_stack[self.current_index].pop()
+            self.push_undo_state(False)
+            self.undo_stack[self.current_index].attach_command(change)
+            
+            self.apply_layer_change(change, redo=True)
+            return
+        
+        if change is not None:
+            self.redo_stack[self.current_index].pop()
+            self.push_undo_change(change, reset_redo=False)
+            
+            self.apply_layer_change(change, redo=True)
+            return
+        
         self.push_undo_state(False)
         layers_data = self.redo_stack[self.current_index].pop().copy()
         layers = self.get_all_backup_layer(layers_data)
@@ -2578,8 +2756,7 @@ class myWindowsOpencV(QMainWindow):
         
         # Update my_image with current display image for matplotlib display
         temp_image = myImage()
-        _, layers = self.image_list[self.current_index]
-        composite_img = LayerManager.compose_layers(layers)
+        composite_img = self.get_composite(self.current_index).copy()
         temp_image.image = composite_img
         title = os.path.basename(self.image_list[self.current_index][0]) if self.current_index != -1 else "Image"
         temp_image.showImage(title)
@@ -2685,21 +2862,9 @@ class myWindowsOpencV(QMainWindow):
         """
         Draws text using QPainter
         """
-        if not image.flags['C_CONTIGUOUS']:
-            image = np.ascontiguousarray(image)
-
-        h, w, channels = image.shape
-        if channels == 3:
-            rgb_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            fmt = QImage.Format_RGB888
-        elif channels == 4:
-            rgb_img = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
-            fmt = QImage.Format_RGBA8888
-        
-        qimg = QImage(
-            rgb_img.data, 
-            w, h, image.strides[0], fmt
-        )
+        # Paint directly on a single copy of image
+        canvas = image.copy()
+        qimg = ImageBridge.to_qimage(canvas)
         
         painter = QPainter(qimg)
         painter.setRenderHint(QPainter.TextAntialiasing)
@@ -2719,15 +2884,7 @@ class myWindowsOpencV(QMainWindow):
         painter.drawText(x, y, text)
         painter.end()
         
-        ptr = qimg.bits()
-        ptr.setsize(h * w * channels)
-        arr = np.frombuffer(ptr, np.uint8).reshape((h, w, channels))
-        
-        # 8. Convert back to BGR for OpenCV
-        if channels == 4:
-            return cv2.cvtColor(arr, cv2.COLOR_RGBA2BGRA)
-        else:
-            return cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+        return canvas
         
     def apply_text_on_click(self, event, image, text, font_scale, color, thickness):
         if self.display_image is None: return
@@ -2818,8 +2975,7 @@ class myWindowsOpencV(QMainWindow):
         
         image = None
         if self.display_image is not None:
-            _, layers = self.image_list[self.main_index]
-            image = LayerManager.compose_layers(layers)
+            image = self.get_composite(self.main_index).copy()
         
         self.barcode = barcode.BarcodeReader(self, image)
         self.barcode.show()